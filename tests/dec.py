@@ -4,6 +4,8 @@ Tests the decorators.py module
 
 from fabric.api import settings, sudo
 
+from woven.environment import flush_states
+
 from woven.decorators import run_once_per_node, run_once_per_version
 
 H = '192.168.188.10'
@@ -12,6 +14,7 @@ R = 'root'
 
 def teardown():
     with settings(host_string=HS,user=R,password=R,project_fullname='example-0.2'):
+        flush_states()
         sudo('rm -rf /var/local/woven')
 
 def test_dec_run_once_per_node():
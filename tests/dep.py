@@ -1,7 +1,12 @@
+import os, shutil, tempfile
+
 from fabric.contrib.files import exists
 from fabric.api import sudo, settings
 
-from woven.deployment import _backup_file, _restore_file
+from woven.deployment import _backup_file, _restore_file, _rsync_excluded, _itemized_files, _include_filter, batch, mkdirs
+from woven.deployment import deploy_files
+from woven.project import _fingerprinted, _compressed
+from woven import facts
 
 H = '192.168.188.10'
 HS = 'root@192.168.188.10:22'
@@ -17,4 +22,101 @@ def test_dep_backup_file():
         
     
 
+def test_dep_host_facts():
+    with settings(hosts=[H],host_string=HS,user=R,password=R):
+        sudo('rm -rf /var/local/woven-test')
+        facts.clear_facts()
+        assert facts.exists('/etc/passwd')
+        assert not facts.exists('/var/local/woven-test')
+        assert facts.contains('/etc/passwd','root')
+        assert 'python' in facts.command_fact('python_version').lower()
+        #mutations through woven invalidate the cache
+        mkdirs('/var/local/woven-test/sub',use_sudo=True)
+        assert facts.exists('/var/local/woven-test')
+        assert facts.exists('/var/local/woven-test/sub')
+        sudo('rm -rf /var/local/woven-test')
+        facts.clear_facts()
+
+def test_dep_batch():
+    with settings(hosts=[H],host_string=HS,user=R,password=R):
+        with batch(use_sudo=True) as commands:
+            commands.add('echo one')
+            commands.add('test -e /nonexistent', warn_only=True)
+            commands.add('whoami')
+        one, missing, user = commands.results
+        assert one == 'one' and one.succeeded
+        assert missing.failed and missing.return_code == 1
+        assert user == 'root'
+
+def test_dep_deploy_files_link_dest():
+    local_dir = tempfile.mkdtemp()
+    try:
+        open(os.path.join(local_dir,'views.py'),'w').write('#views')
+        with settings(hosts=[H],host_string=HS,user=R,password=R,overwrite=False):
+            sudo('rm -rf /var/local/woven-test')
+            root = '/var/local/woven-test'
+            deploy_files(local_dir, root+'/v1', manifest=True, use_sudo=True)
+            #nothing changed in the next two versions
+            deploy_files(local_dir, root+'/v2', manifest=True, use_sudo=True, link_dest=root+'/v1')
+            assert exists('/var/local/woven-test/.v2.woven-manifest')
+            deploy_files(local_dir, root+'/v3', manifest=True, use_sudo=True, link_dest=root+'/v2')
+            #the same file in every version
+            assert sudo('stat -c %h '+root+'/v3/views.py') == '3'
+            sudo('rm -rf /var/local/woven-test')
+            facts.clear_facts()
+    finally:
+        shutil.rmtree(local_dir)
+
+def test_dep_rsync_excluded():
+    exclude = ['local_settings*','*.pyc','.*','/build','/media*']
+    assert _rsync_excluded('app/views.pyc', exclude)
+    assert _rsync_excluded('.git', exclude)
+    assert _rsync_excluded('app/.svn/entries', exclude)
+    assert _rsync_excluded('build', exclude)
+    assert _rsync_excluded('media/css/base.css', exclude)
+    assert not _rsync_excluded('app/build/views.py', exclude)
+    assert not _rsync_excluded('app/views.py', exclude)
+    assert _rsync_excluded('app/templates/base.html', ['templates/*.html'])
+
+def test_dep_include_filter():
+    filter_file = _include_filter(['css/base.css','img/logo[1].png','robots.txt'])
+    try:
+        rules = open(filter_file).read().split('\n')
+    finally:
+        os.remove(filter_file)
+    assert rules == ['/css/','/css/base.css','/img/','/img/logo\\[1].png','/robots.txt','']
+
+def test_dep_itemized_files():
+    output = ['created directory /home/root/env/example-0.2/project',
+              'cd+++++++++ ./',
+              '>f+++++++++ app/views.py',
+              'hf          app/models.py',
+              'cL+++++++++ app/link -> views.py',
+              '.d..t...... app/',
+              '']
+    assert _itemized_files(output) == ['app/views.py','app/models.py','app/link','app']
+
+def test_dep_fingerprinted():
+    hashed = '0123456789abcdef0123'
+    assert _fingerprinted('css/base.css', hashed) == 'css/base.0123456789ab.css'
+    assert _fingerprinted('robots', hashed) == 'robots.0123456789ab'
 
+def test_dep_compressed():
+    tmp = tempfile.mkdtemp()
+    try:
+        text = os.path.join(tmp,'base.css')
+        open(text,'w').write('body { margin: 0; }\n' * 100)
+        compressed = _compressed(text, 'texthash', tmp, '.gz')
+        assert compressed == os.path.join(tmp,'texthash.gz')
+        assert os.path.getsize(compressed) < os.path.getsize(text)
+        #cached by the hash
+        open(text,'w').write('changed')
+        assert _compressed(text, 'texthash', tmp, '.gz') == compressed
+        #a file that doesn't get smaller leaves an empty marker
+        tiny = os.path.join(tmp,'tiny.css')
+        open(tiny,'w').write('a')
+        assert _compressed(tiny, 'tinyhash', tmp, '.gz') == ''
+        assert os.path.getsize(os.path.join(tmp,'tinyhash.gz')) == 0
+        assert _compressed(tiny, 'tinyhash', tmp, '.gz') == ''
+    finally:
+        shutil.rmtree(tmp)
@@ -4,15 +4,17 @@ from fabric.state import env
 
 from woven.environment import _root_domain, _parse_project_version
 from woven.environment import set_env, server_state, set_server_state
-from woven.environment import version_state, set_version_state
+from woven.environment import version_state, set_version_state, flush_states, rolling_batches
 H = '192.168.188.10'
 HS = 'root@192.168.188.10:22'
 R = 'root'
 
 def setup():
+    flush_states()
     sudo('rm -rf /var/local/woven')
 
 def teardown():
+    flush_states()
     sudo('rm -rf /var/local/woven')
     
 def test_env_set_env():
@@ -49,6 +51,9 @@ def test_env_version_state():
         set_version_state('example',object=['something'])
         state = version_state('example')
         assert state == ['something']
+        flush_states()
+        state = version_state('example')
+        assert state == ['something']
         state = version_state('example', prefix=True)
         assert state
         
@@ -104,4 +109,14 @@ def test_env_root_domain():
         #In the event of noinput, the domain will default to example.com
         domain = _root_domain()
         print domain
-        assert domain == 'example.com'
\ No newline at end of file
+        assert domain == 'example.com'
+
+def test_env_rolling_batches():
+    hosts = ['a:10022','b:10022','c:10022','d:10022','e:10022']
+    with settings(role_lookup={'a:10022':'web','b:10022':'web','c:10022':'web','d:10022':'web','e:10022':''}):
+        batches = rolling_batches(hosts, 2)
+        assert batches == [('',['e:10022']),('web',['a:10022','b:10022']),('web',['c:10022','d:10022'])]
+        batches = rolling_batches(hosts, '50%', 1)
+        assert [len(b) for r,b in batches] == [1,1,1,1,1]
+        batches = rolling_batches(hosts, '10%')
+        assert len(batches) == 5
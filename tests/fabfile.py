@@ -26,16 +26,22 @@ from woven.environment import set_env
 
 #import tests
 from env import test_env_set_env, test_env_server_state, test_env_parse_project_version, test_env_root_domain
-from env import test_env_version_state
+from env import test_env_version_state, test_env_rolling_batches
 
 #from ubu import test_ubu_disable_root, test_ubu_change_ssh_port, test_ubu_port_is_open
 #from ubu import test_ubu_setup_ufw, test_ubu_post_install_package, test_ubu_post_setupnode
 
-from web import test_web_site_users
+from vir import test_vir_requirements_hash, test_vir_requirement_name, test_vir_wheelhouse_platform
+from vir import test_vir_evict_pip_cache, test_vir_shared_src_name
+from web import test_web_site_users, test_web_percentiles, test_web_size_apache
+from web import test_web_size_gunicorn, test_web_gunicorn_options, test_web_backend_context
+from web import test_web_static_profile, test_web_proxy_cache
 from lin import test_lin_add_repositories, test_lin_uninstall_packages
-from lin import test_lin_setup_ufw_rules, test_lin_disable_root
+from lin import test_lin_setup_ufw_rules, test_lin_disable_root, test_lin_package_cache_rules
 from dec import test_dec_run_once_per_node, test_dec_run_once_per_version
-from dep import test_dep_backup_file
+from dep import test_dep_backup_file, test_dep_host_facts, test_dep_batch, test_dep_rsync_excluded
+from dep import test_dep_itemized_files, test_dep_fingerprinted, test_dep_compressed
+from dep import test_dep_include_filter, test_dep_deploy_files_link_dest
 
 #Set the environ for Django
 settings_module = os.environ['DJANGO_SETTINGS_MODULE'] = 'example_project.setting'
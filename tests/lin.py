@@ -7,7 +7,7 @@ from fabric.state import connections, env
 from fabric.network import join_host_strings, normalize
 
 from woven.linux import disable_root, change_ssh_port, port_is_open, setup_ufw
-from woven.linux import setup_ufw_rules
+from woven.linux import setup_ufw_rules, package_cache_rules
 from woven.linux import uninstall_packages
 from woven.linux import add_repositories
 
@@ -162,3 +162,9 @@ def test_lin_setup_ufw():
 def test_lin_uninstall_packages():
     uninstall_packages()
     
+
+def test_lin_package_cache_rules():
+    rules = package_cache_rules(['192.168.188.11','192.168.188.10','192.168.188.11'], 3142)
+    assert rules == ['allow from 192.168.188.10 to any port 3142 proto tcp',
+                     'allow from 192.168.188.11 to any port 3142 proto tcp']
+    assert package_cache_rules(['10.0.0.0/8'], 3142) == ['allow from 10.0.0.0/8 to any port 3142 proto tcp']
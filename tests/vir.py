@@ -1,7 +1,81 @@
 
+import os, shutil, subprocess, sys, tempfile, time
+
+from fabric.api import settings
 from fabric.state import env
 
-    
+from woven.virtualenv import requirements_hash, _requirement_name, _shared_src_name, wheelhouse_platform, EVICT_SCRIPT
+
+def test_vir_requirements_hash():
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp()
+    try:
+        os.chdir(tmp)
+        with settings(PIP_REQUIREMENTS=[]):
+            open('requirements.txt','w').write('South==0.7\n')
+            hashed = requirements_hash()
+            assert hashed == requirements_hash()
+            #the same requirements in another directory are equivalent
+            os.chdir(cwd)
+            other = tempfile.mkdtemp()
+            os.chdir(other)
+            open('requirements.txt','w').write('South==0.7\n')
+            assert requirements_hash() == hashed
+            shutil.rmtree(other)
+            os.chdir(tmp)
+            open('requirements.txt','w').write('South==0.7.1\n')
+            assert requirements_hash() <> hashed
+            #a bundle in dist changes it too
+            open('requirements.txt','w').write('South==0.7\n')
+            os.mkdir('dist')
+            open(os.path.join('dist','requirements.zip'),'wb').write('bundle')
+            assert requirements_hash() <> hashed
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp)
+
+def test_vir_requirement_name():
+    assert _requirement_name('Django==1.2.3') == 'django'
+    assert _requirement_name('django_tagging>=0.3') == 'django-tagging'
+    assert _requirement_name('-e git+git://github.com/example/app.git#egg=Example_App') == 'example-app'
+    assert _requirement_name('-e svn+http://svn.example.com/trunk@10#egg=app&subdirectory=src') == 'app'
+    assert _requirement_name('--find-links=http://dist.example.com') == ''
+    assert _requirement_name('-r base.txt') == ''
 
+def test_vir_shared_src_name():
+    app = _shared_src_name('-e git+git://github.com/example/app.git#egg=App')
+    assert app.startswith('app-')
+    #another revision of the same repository shares the checkout
+    assert _shared_src_name('-e git+git://github.com/example/app.git@v1.0#egg=App') == app
+    assert _shared_src_name('-e git+git://github.com/fork/app.git#egg=App') <> app
+    assert _shared_src_name('-e git+ssh://git@github.com/example/app.git#egg=App') <> app
 
+def test_vir_wheelhouse_platform():
+    assert wheelhouse_platform('linux','x86_64','2.6.5') == 'linux-x86_64-py2.6'
+    assert wheelhouse_platform('linux','i686','2.7') == 'linux-i686-py2.7'
+    #defaults to the local platform
+    assert wheelhouse_platform().count('-') >= 2
 
+def test_vir_evict_pip_cache():
+    tmp = tempfile.mkdtemp()
+    try:
+        cache, src = os.path.join(tmp,'cache'), os.path.join(tmp,'src')
+        os.makedirs(cache)
+        os.makedirs(os.path.join(src,'app'))
+        now = time.time()
+        for name, age in [('old.tar.gz',300), ('older.tar.gz',400), ('new.tar.gz',0)]:
+            path = os.path.join(cache,name)
+            open(path,'wb').write('x' * 400 * 1024)
+            open(path + '.content-type','w').write('application/x-tar')
+            os.utime(path, (now - age, now - age))
+            os.utime(path + '.content-type', (now - age, now - age))
+        #a checkout used more recently than the downloads
+        open(os.path.join(src,'app','setup.py'),'wb').write('x' * 400 * 1024)
+        #evict the least recently used until there is no more than 1MB
+        p = subprocess.Popen([sys.executable, '-', '1', cache, src], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        removed = p.communicate(EVICT_SCRIPT)[0].split()
+        assert removed == [os.path.join(cache,'older.tar.gz'), os.path.join(cache,'old.tar.gz')]
+        assert sorted(os.listdir(cache)) == ['new.tar.gz','new.tar.gz.content-type']
+        assert os.path.exists(os.path.join(src,'app','setup.py'))
+    finally:
+        shutil.rmtree(tmp)
@@ -1,6 +1,7 @@
 from fabric.api import *
 
-from woven.webservers import _site_users
+from woven.webservers import _site_users, _percentiles, _size_apache, _size_gunicorn, gunicorn_options
+from woven.webservers import _backend_context, backend_job, backend_port, static_profile, proxy_cache
 from woven.linux import add_user
 
 def test_web_site_users():
@@ -12,4 +13,98 @@ def test_web_site_users():
         add_user(username='site_1',group='www-data',site_user=True)
         users = _site_users()
         assert users[0] == 'site_1'
-        
\ No newline at end of file
+        
+
+def test_web_percentiles():
+    latency = _percentiles([i / 100.0 for i in range(100, 0, -1)])
+    assert latency['p50'] == 0.51
+    assert latency['p95'] == 0.95
+    assert latency['p99'] == 0.99
+    assert _percentiles([]) == {}
+
+def test_web_size_apache():
+    conf = {'WSGI_PROCESSES':0, 'WSGI_THREADS':15, 'WSGI_PROCESS_MEMORY':64,
+            'APACHE_RESERVED_MEMORY':256, 'APACHE_START_SERVERS':0, 'APACHE_MAX_CLIENTS':0}
+    #a small host keeps the previous MaxClients
+    small = _size_apache(conf, 1, 512, 1)
+    assert small['WSGI_PROCESSES'] == 1
+    assert small['APACHE_MAX_CLIENTS'] == 100
+    assert small['APACHE_START_SERVERS'] == 1
+    #a process per cpu for each site, capped by memory
+    large = _size_apache(conf, 8, 2048, 3)
+    assert large['WSGI_PROCESSES'] == 8
+    assert large['APACHE_MAX_CLIENTS'] == 375
+    assert large['APACHE_START_SERVERS'] == 8
+    assert _size_apache(conf, 8, 1024, 4)['WSGI_PROCESSES'] == 3
+    #settings are left alone
+    fixed = dict(conf, WSGI_PROCESSES=2, APACHE_MAX_CLIENTS=150)
+    assert _size_apache(fixed, 8, 2048, 3)['APACHE_MAX_CLIENTS'] == 150
+    assert conf['WSGI_PROCESSES'] == 0
+
+def test_web_size_gunicorn():
+    conf = {'GUNICORN_WORKERS':0, 'GUNICORN_WORKER_CLASS':'', 'GUNICORN_THREADS':0,
+            'GUNICORN_WORKER_MEMORY':64, 'GUNICORN_RESERVED_MEMORY':256}
+    #2 x cpus + 1 sync workers
+    assert _size_gunicorn(conf, 4, 4096)['GUNICORN_WORKERS'] == 9
+    #capped by memory
+    assert _size_gunicorn(conf, 4, 512)['GUNICORN_WORKERS'] == 4
+    #a worker per cpu for other worker classes
+    gevent = _size_gunicorn(dict(conf, GUNICORN_WORKER_CLASS='gevent'), 4, 4096)
+    assert gevent['GUNICORN_WORKERS'] == 4 and not gevent['GUNICORN_THREADS']
+    gthread = _size_gunicorn(dict(conf, GUNICORN_WORKER_CLASS='gthread'), 4, 4096)
+    assert gthread['GUNICORN_WORKERS'] == 4 and gthread['GUNICORN_THREADS'] == 4
+    #shared by the sized sites after the fixed workers of the others
+    assert _size_gunicorn(conf, 4, 4096, 3, 2, 3)['GUNICORN_WORKERS'] == 3
+    assert _size_gunicorn(conf, 1, 0, 3, 3)['GUNICORN_WORKERS'] == 1
+    assert _size_gunicorn(dict(conf, GUNICORN_WORKERS=2), 4, 4096)['GUNICORN_WORKERS'] == 2
+
+def test_web_gunicorn_options():
+    conf = {'GUNICORN_WORKERS':3, 'GUNICORN_WORKER_CLASS':'gevent', 'GUNICORN_THREADS':0,
+            'GUNICORN_TIMEOUT':60, 'GUNICORN_MAX_REQUESTS':0}
+    assert gunicorn_options(conf) == '--workers=3 --worker-class=gevent --timeout=60'
+
+def test_web_backend_context():
+    with settings(BLUE_GREEN=False, NGINX_UPSTREAM_SOCKET=False, NGINX_UPSTREAM_KEEPALIVE=8,
+                  DEPLOYMENT_ROOT='/home/woven', project_name='example', project_fullname='example-0.1'):
+        context = _backend_context('gunicorn', 'example.com')
+        assert context['venv'] == '/home/woven/env/example'
+        assert context['backend'] == '127.0.0.1:10081'
+        assert context['binds'] == '-b 127.0.0.1:10081'
+        assert context['upstream_keepalive'] == 8
+        assert context['process_name'] == 'example.com'
+        assert context['job'] == 'gunicorn-example'
+        assert _backend_context('apache2')['backend_port'] == 10080
+        with settings(NGINX_UPSTREAM_SOCKET=True):
+            context = _backend_context('gunicorn')
+            assert context['backend'] == 'unix:/tmp/gunicorn-example.sock'
+            assert context['binds'] == '-b unix:/tmp/gunicorn-example.sock'
+        #the green slot
+        assert backend_port('gunicorn', 'green') == 10083
+        assert backend_port('apache2', 'green') == 10082
+        assert backend_job('gunicorn', 'green') == 'gunicorn-example-green'
+        assert backend_job('gunicorn', '', 'admin_settings.py') == 'gunicorn-example-admin'
+
+def test_web_static_profile():
+    with settings(NGINX_STATIC_PROFILE=False, NGINX_STATIC_EXPIRES='max', NGINX_STATIC_MEDIA_EXPIRES='7d',
+                  NGINX_STATIC_OPEN_FILE_CACHE='max=2000 inactive=60s', NGINX_STATIC_GZIP=True,
+                  NGINX_STATIC_SENDFILE_MAX_CHUNK='512k',
+                  SITE_STATIC_PROFILES={'example.com':{'NGINX_STATIC_PROFILE':True, 'NGINX_STATIC_EXPIRES':'1h'}}):
+        assert static_profile('other.com') is None
+        profile = static_profile('example.com')
+        assert profile['expires'] == '1h'
+        assert profile['media_expires'] == '7d'
+        assert profile['gzip_static']
+        assert profile['open_file_cache'] == 'max=2000 inactive=60s'
+        assert profile['sendfile_max_chunk'] == '512k'
+
+def test_web_proxy_cache():
+    with settings(NGINX_PROXY_CACHE=True, NGINX_PROXY_CACHE_TTL='10s', NGINX_PROXY_CACHE_ZONE_SIZE='10m',
+                  NGINX_PROXY_CACHE_MAX_SIZE='256m', NGINX_PROXY_CACHE_BYPASS_COOKIES=['sessionid','csrftoken'],
+                  SITE_PROXY_CACHES={'admin.example.com':{'NGINX_PROXY_CACHE':False},
+                                     'api.example.com':{'NGINX_PROXY_CACHE_BYPASS_COOKIES':[]}}):
+        cache = proxy_cache('example.com')
+        assert cache['path'] == '/var/cache/nginx/woven/example_com'
+        assert cache['ttl'] == '10s'
+        assert cache['bypass'] == '$cookie_sessionid $cookie_csrftoken'
+        assert proxy_cache('admin.example.com') is None
+        assert proxy_cache('api.example.com')['bypass'] == '0'
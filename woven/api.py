@@ -11,9 +11,11 @@ from woven.deployment import upload_template
 
 from woven.environment import check_settings, deployment_root, set_env, patch_project
 from woven.environment import get_project_version, server_state, set_server_state
-from woven.environment import set_version_state, version_state, get_packages
+from woven.environment import set_version_state, version_state, flush_states, get_packages
 from woven.environment import post_install_package, post_exec_hook
 
+from woven.facts import host_facts, invalidate
+
 from woven.project import deploy_static, deploy_media, deploy_project, deploy_db, deploy_templates
 
 from woven.linux import add_user, install_package, port_is_open, skip_disable_root
@@ -39,7 +41,10 @@ def deploy(overwrite=False):
     deploy_funcs = [deploy_project,deploy_templates, deploy_static, deploy_media,  deploy_webconf, deploy_wsgi]
     if not patch_project() or overwrite:
         deploy_funcs = [deploy_db,mkvirtualenv,pip_install_requirements] + deploy_funcs
-    for func in deploy_funcs: func()
+    try:
+        for func in deploy_funcs: func()
+    finally:
+        flush_states()
 
 
 def setupnode(overwrite=False):
@@ -69,6 +74,7 @@ def setupnode(overwrite=False):
     setup_ufw_rules()
     set_timezone()
     set_server_state('setupnode-incomplete',delete=True)
+    flush_states()
     #stop and start webservers - and reload nginx
     for s in webserver_list():
         stop_webserver(s)
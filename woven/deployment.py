@@ -1,16 +1,21 @@
 #!/usr/bin/env python
+from contextlib import contextmanager
+from fnmatch import fnmatch
 from functools import wraps
 from glob import glob
 from hashlib import sha1
-import os, shutil, sys, tempfile
+import base64, json, os, posixpath, re, sys, tarfile, tempfile
 
 from django.template.loader import render_to_string
 
-from fabric.state import env
-from fabric.operations import run, sudo, put
+from fabric.state import env, output
+from fabric.operations import local, run, sudo, put, _AttributeString
 from fabric.context_managers import cd, settings, hide
-from fabric.contrib.files import exists
-from fabric.contrib.project import rsync_project
+from fabric.utils import abort, warn
+
+from woven.environment import remote_python
+from woven.facts import exists, invalidate
+from woven.network import ssh_command
 
 def _backup_file(path):
     """
@@ -20,8 +25,9 @@ def _backup_file(path):
     backup_path = ''.join([backup_base,path])
     if not exists(backup_path):
         directory = ''.join([backup_base,os.path.split(path)[0]])
-        sudo('mkdir -p %s'% directory)
+        mkdirs(directory, use_sudo=True)
         sudo('cp %s %s'% (path,backup_path))
+        invalidate(backup_path)
 
 def _restore_file(path, delete_backup=True):
     """
@@ -34,6 +40,7 @@ def _restore_file(path, delete_backup=True):
             sudo('mv -f %s %s'% (backup_path,path))
         else:
             sudo('cp -f %s %s'% (backup_path,path))
+        invalidate(backup_path,path)
 
 
 def _get_local_files(local_dir, pattern=''):
@@ -60,37 +67,301 @@ def _get_local_files(local_dir, pattern=''):
         os.chdir(cwd)
     return local_files
 
-def _stage_local_files(local_dir, local_files={}):
+def _rsync(local_dir, remote_dir, exclude=[], delete=False, extra_opts=''):
     """
-    Either ``local_files`` and/or ``context`` should be supplied.
-    
-    Will stage a ``local_files`` dictionary of path:filename pairs where path
-    is relative to ``local_dir`` into a local tmp staging directory.
+    As per fabric ``rsync_project`` but the ssh connection is shared with
+    any other rsync to the same host during the command.
+    """
+    exclude_opts = ' '.join(['--exclude "%s"'% e.replace('"','\\"') for e in exclude])
+    options = [delete and '--delete' or '', exclude_opts, '-pthrvz', extra_opts,
+               "--rsh='%s'"% ssh_command()]
+    options = ' '.join([o for o in options if o])
+    return local('rsync %s %s %s@%s:%s'% (options, local_dir, env.user, env.host, remote_dir))
+
+#Runs the batched commands in order and prints their results as json
+BATCH_SCRIPT = r"""
+import base64, json, subprocess, sys
+results = []
+commands = json.loads(base64.b64decode(sys.argv[1]))
+#tells woven the commands may have run
+print 'woven-batch-started'
+sys.stdout.flush()
+for command, warn_only in commands:
+    p = subprocess.Popen(command, shell=True, executable='/bin/bash',
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    out = p.communicate()[0]
+    results.append((p.returncode, out.strip().decode('utf-8','replace')))
+    if p.returncode and not warn_only: break
+print json.dumps(results)
+"""
+
+class CommandBatch(object):
+    """
+    Records commands and runs them on the host in a single round trip.
+
+    Commands run in order and stop at the first failure unless they were
+    added with ``warn_only``, as they would with sequential run or sudo calls.
+    After execution ``results`` holds the output of each command with
+    ``return_code``, ``failed`` and ``succeeded`` as per fabric.
+    """
+    def __init__(self, use_sudo=False):
+        self.use_sudo = use_sudo
+        self.commands = []
+        self.results = []
+
+    def add(self, command, warn_only=False):
+        """
+        Record a ``command`` in the current ``cd`` directory
+        """
+        if env.get('cwd'): command = 'cd %s && %s'% (env.cwd, command)
+        self.commands.append((command, bool(warn_only or env.warn_only)))
+
+    def execute(self):
+        """
+        Run the recorded commands. Returns the results
+        """
+        if not self.commands: return self.results
+        name = self.use_sudo and 'sudo' or 'run'
+        if output.running:
+            for command, warn_only in self.commands:
+                print "[%s] %s: %s"% (env.host_string, name, command)
+        script_output = remote_python(BATCH_SCRIPT, base64.b64encode(json.dumps(self.commands)),
+                                      use_sudo=self.use_sudo)
+        try:
+            results = json.loads(script_output.split('\n')[-1])
+        except ValueError:
+            results = None
+        if (script_output.failed or results is None) and 'woven-batch-started' in script_output:
+            #some commands may have run so they can't safely be run again
+            abort("%s() batch did not complete on %s:\n%s"% (name, env.host_string, script_output))
+        if script_output.failed or results is None:
+            #no python on the host - run them one at a time
+            func = self.use_sudo and sudo or run
+            for command, warn_only in self.commands:
+                with settings(hide('running'), warn_only=warn_only, cwd=''):
+                    self.results.append(func(command))
+            return self.results
+        for (command, warn_only), (return_code, out) in zip(self.commands, results):
+            result = _AttributeString(out)
+            result.return_code = return_code
+            result.failed = return_code <> 0
+            result.succeeded = not result.failed
+            self.results.append(result)
+            if output.stdout and out:
+                for line in out.split('\n'):
+                    print "[%s] out: %s"% (env.host_string, line)
+            if result.failed:
+                msg = "%s() encountered an error (return code %s) while executing '%s'"% (name, return_code, command)
+                if warn_only: warn(msg)
+                else: abort(msg)
+        return self.results
+
+@contextmanager
+def batch(use_sudo=False):
+    """
+    Record the commands added in the block and run them in one round trip
+    when it exits, eg::
     
-    Returns a path to the temporary local staging directory
+        with batch(use_sudo=True) as commands:
+            for rule in rules:
+                commands.add('ufw %s'% rule, warn_only=True)
+        failed = [r for r in commands.results if r.failed]
+    """
+    commands = CommandBatch(use_sudo)
+    yield commands
+    commands.execute()
+
+def _rsync_excluded(path, exclude):
+    """
+    True if the relative ``path`` matches an rsync style ``exclude`` pattern.
+    Patterns starting with / are anchored to the root of the deployed directory
+    """
+    parts = path.split(os.sep)
+    for pattern in exclude:
+        anchored = pattern.startswith('/')
+        pattern = pattern.strip('/')
+        depth = pattern.count('/') + 1
+        if anchored:
+            if len(parts) >= depth and fnmatch('/'.join(parts[:depth]), pattern): return True
+        else:
+            for i in range(depth, len(parts)+1):
+                if fnmatch('/'.join(parts[i-depth:i]), pattern): return True
+    return False
 
+def _walk_local_files(local_dir, local_files={}, exclude=[]):
+    """
+    Yields the paths relative to ``local_dir`` of the files that would be deployed,
+    optionally limited to a ``local_files`` dictionary from _get_local_files
     """
-    staging_dir = os.path.join(tempfile.mkdtemp(),os.path.basename(local_dir))
-    os.mkdir(staging_dir)
     for root, dirs, files in os.walk(local_dir):
         relative_tree = root.replace(local_dir,'')
         if relative_tree:
             relative_tree = relative_tree[1:]
+        dirs[:] = [d for d in dirs if not _rsync_excluded(os.path.join(relative_tree,d), exclude)]
         if local_files:
             files = local_files.get(relative_tree,[])
         for file in files:
-            if relative_tree:
-                filepath = os.path.join(relative_tree,file)
-                if not os.path.exists(os.path.join(staging_dir,relative_tree)):
-                    os.mkdir(os.path.join(staging_dir,relative_tree))
-            else: filepath = file
-            shutil.copy2(os.path.join(root,file),os.path.join(staging_dir,filepath))
-    return staging_dir
+            path = os.path.join(relative_tree,file)
+            if not _rsync_excluded(path, exclude) and os.path.isfile(os.path.join(local_dir,path)):
+                yield path
 
-def deploy_files(local_dir, remote_dir, pattern = '',rsync_exclude=['*.pyc','.*'], use_sudo=False):
+def _local_index(local_dir, paths):
+    """
+    Returns a dictionary of relative path:(size, mtime, sha1) for ``paths``.
+
+    Hashes are kept in ~/.woven/index and only recalculated for files
+    whose size or modification time has changed.
+    """
+    index_dir = os.path.join(os.path.expanduser('~'),'.woven','index')
+    index_file = os.path.join(index_dir, sha1(os.path.abspath(local_dir)).hexdigest())
+    try:
+        previous = json.load(open(index_file))
+    except (IOError, ValueError):
+        previous = {}
+    index = {}
+    for path in paths:
+        stat = os.stat(os.path.join(local_dir,path))
+        entry = previous.get(path)
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime:
+            index[path] = entry
+            continue
+        f = open(os.path.join(local_dir,path),'rb')
+        hashed = sha1()
+        for chunk in iter(lambda: f.read(65536), ''):
+            hashed.update(chunk)
+        f.close()
+        index[path] = [stat.st_size, stat.st_mtime, hashed.hexdigest()]
+    if not os.path.exists(index_dir): os.makedirs(index_dir)
+    f = open(index_file,'w')
+    json.dump(index, f)
+    f.close()
+    return index
+
+def _remote_manifest_path(remote_dir):
+    """
+    The manifest of files deployed to ``remote_dir`` is kept beside it
+    """
+    parent, name = posixpath.split(remote_dir)
+    return posixpath.join(parent, '.%s.woven-manifest'% name)
+
+def _read_remote_manifest(manifest_path, use_sudo=False):
+    """
+    The remote manifest at ``manifest_path`` or None
+    """
+    func = use_sudo and sudo or run
+    #without a pty the json isn't mangled by line endings or echoed input
+    with settings(hide('running','stdout'), warn_only=True):
+        output = func('test -f %s && cat %s'% (manifest_path, manifest_path), pty=False)
+    if output.succeeded:
+        try:
+            return json.loads(output)
+        except ValueError:
+            print env.host, "WARNING: Could not read the manifest %s. All files will be deployed"% manifest_path
+    return None
+
+def _deploy_changed_files(local_dir, remote_dir, paths, use_sudo=False, link_dest=''):
+    """
+    Send only the files in ``paths`` whose hash differs from the remote manifest.
+    
+    A new ``remote_dir`` is first seeded with hard links to the files in ``link_dest``
+    
+    Returns a list of the directories and files created or changed on the host,
+    including the files hard linked from ``link_dest``.
+    """
+    func = use_sudo and sudo or run
+    index = _local_index(local_dir, paths)
+    manifest_path = _remote_manifest_path(remote_dir)
+    remote = None
+    linked = []
+    if not env.overwrite:
+        remote = _read_remote_manifest(manifest_path, use_sudo)
+    mkdirs(remote_dir, use_sudo)
+    if remote is None and link_dest and link_dest <> remote_dir:
+        remote = _read_remote_manifest(_remote_manifest_path(link_dest), use_sudo)
+        if remote is not None:
+            #the manifest is beside the directory so it is copied too, even if nothing changes
+            func('cp -al %s/. %s/ && cp -f %s %s'% (link_dest, remote_dir, _remote_manifest_path(link_dest), manifest_path))
+            linked = sorted([path for path, entry in index.items() if remote.get(path) == entry[2]])
+    if remote is None: remote = {}
+    
+    changed = sorted([path for path, entry in index.items() if remote.get(path) <> entry[2]])
+    linked = ['/'.join([remote_dir,path.replace(os.sep,'/')]) for path in linked]
+    if not changed: return linked
+    #directories that hold no previously deployed files are new
+    remote_dirs = set([os.path.dirname(path) for path in remote])
+    for path in remote_dirs.copy():
+        while path:
+            path = os.path.dirname(path)
+            remote_dirs.add(path)
+    created_dirs = set([])
+    for path in changed:
+        path = os.path.dirname(path)
+        while path and path not in remote_dirs:
+            created_dirs.add(path)
+            path = os.path.dirname(path)
+    for path in changed:
+        remote[path] = index[path][2]
+    
+    #one archive with the changed files and the new manifest
+    fd, archive = tempfile.mkstemp(suffix='.tar.gz')
+    os.close(fd)
+    tar = tarfile.open(archive,'w:gz')
+    for path in changed:
+        tar.add(os.path.join(local_dir,path), path.replace(os.sep,'/'))
+    fd, manifest_file = tempfile.mkstemp()
+    os.write(fd, json.dumps(remote))
+    os.close(fd)
+    tar.add(manifest_file, '.woven-manifest')
+    tar.close()
+    remote_archive = '/tmp/woven-%s-%s.tar.gz'% (env.user, sha1(remote_dir).hexdigest()[:8])
+    put(archive, remote_archive)
+    os.remove(archive)
+    os.remove(manifest_file)
+    #unlink first so files hard linked to other versions are replaced, not changed
+    func(' && '.join(['tar --no-same-owner --unlink-first -xzf %s -C %s'% (remote_archive, remote_dir),
+                      'mv -f %s/.woven-manifest %s'% (remote_dir, manifest_path),
+                      'rm -f %s'% remote_archive]))
+    invalidate(remote_dir, manifest_path)
+    
+    return ['/'.join([remote_dir,path.replace(os.sep,'/')]) for path in sorted(created_dirs) + changed] + linked
+
+def _itemized_files(lines):
+    """
+    The file and directory names in rsync --itemize-changes output
+    """
+    files = []
+    for line in lines:
+        #eg '>f+++++++++ path' or 'hf          path' for an unchanged file with -ii
+        match = re.match(r'^[<>ch.][fdLDS][ .+a-zA-Z?]{7,9} (.+)$', line.rstrip('\r'))
+        if not match: continue
+        #drop the target of symlinks and hard links
+        name = match.group(1).split(' -> ')[0].split(' => ')[0].rstrip('/')
+        if name and name <> '.': files.append(name)
+    return files
+
+def _include_filter(paths):
+    """
+    Write rsync include rules for the relative ``paths`` and their parent
+    directories to a temporary file. Returns the filename
+    """
+    rules = set([])
+    for path in paths:
+        path = path.replace(os.sep,'/')
+        for c in '\\*?[':
+            path = path.replace(c,'\\'+c)
+        parts = path.split('/')
+        for i in range(1,len(parts)):
+            rules.add('/%s/'% '/'.join(parts[:i]))
+        rules.add('/'+path)
+    fd, filter_file = tempfile.mkstemp()
+    os.write(fd, '\n'.join(sorted(rules))+'\n')
+    os.close(fd)
+    return filter_file
+
+def deploy_files(local_dir, remote_dir, pattern = '',rsync_exclude=['*.pyc','.*'], use_sudo=False, manifest=None, link_dest=''):
     """
     Generic deploy function for cases where one or more files are being deployed to a host.
-    Wraps around ``rsync_project`` and stages files locally and/or remotely
+    Wraps around rsync and stages files locally and/or remotely
     for network efficiency.
     
     ``local_dir`` is the directory that will be deployed.
@@ -106,43 +377,70 @@ def deploy_files(local_dir, remote_dir, pattern = '',rsync_exclude=['*.pyc','.*'
     ``pattern`` enhances the basic functionality by allowing the python | to include
     multiple patterns. eg '*.txt|Django*'
      
-    ``rsync_exclude`` as per ``rsync_project``
+    ``rsync_exclude`` as per fabric ``rsync_project``
+    
+    ``manifest`` only sends the files whose content has changed since the last
+    deploy to ``remote_dir``. Defaults to the DEPLOY_FILES_MANIFEST setting.
     
-    Returns a list of directories and files created on the host.
+    ``link_dest`` is a remote directory, usually the same directory in the active
+    version, whose unchanged files are hard linked into ``remote_dir`` instead of copied.
+    
+    Returns a list of directories and files created on the host, including
+    those hard linked from ``link_dest``.
     
     """
     #normalise paths
     if local_dir[-1] == os.sep: local_dir = local_dir[:-1]
     if remote_dir[-1] == '/': remote_dir = remote_dir[:-1]
     created_list = []
-    staging_dir = local_dir
     
     #resolve pattern into a dir:filename dict
     local_files = _get_local_files(local_dir,pattern)
-    #If we are only copying specific files or rendering templates we need to stage locally
-    if local_files: staging_dir = _stage_local_files(local_dir, local_files)
+    if manifest is None: manifest = env.DEPLOY_FILES_MANIFEST
+    if manifest:
+        if pattern and not local_files: return []
+        paths = _walk_local_files(local_dir, local_files, rsync_exclude)
+        return _deploy_changed_files(local_dir, remote_dir, paths, use_sudo, link_dest)
     remote_staging_dir = '/home/%s/.staging'% env.user
     if not exists(remote_staging_dir):
-        run(' '.join(['mkdir -pv',remote_staging_dir])).split('\n')
+        mkdirs(remote_staging_dir)
         created_list = [remote_staging_dir]
     
     #upload into remote staging
-    rsync_project(local_dir=staging_dir,remote_dir=remote_staging_dir,exclude=rsync_exclude,delete=True)
+    if local_files:
+        #send only the selected files straight from the local_dir
+        #into a staging directory per pattern
+        paths = list(_walk_local_files(local_dir, local_files))
+        staging_name = '-'.join([os.path.basename(local_dir),sha1(pattern).hexdigest()[:8]])
+        filter_file = _include_filter(paths)
+        try:
+            _rsync(local_dir+os.sep,'/'.join([remote_staging_dir,staging_name]),exclude=rsync_exclude,delete=True,
+                   extra_opts="--include-from=%s --exclude='*' --delete-excluded"% filter_file)
+        finally:
+            os.remove(filter_file)
+    else:
+        paths = os.listdir(local_dir)
+        staging_name = os.path.basename(local_dir)
+        _rsync(local_dir,remote_staging_dir,exclude=rsync_exclude,delete=True)
+    invalidate(remote_staging_dir)
 
     #create the final destination
     created_dir_list = mkdirs(remote_dir, use_sudo)
     
-    if not os.listdir(staging_dir): return created_list
+    if not paths: return created_list
 
     func = use_sudo and sudo or run
-    #cp recursively -R from the staging to the destination and keep a list
-    remote_base_path = '/'.join([remote_staging_dir,os.path.basename(local_dir),'*'])
-    copy_file_list = func(' '.join(['cp -Ruv',remote_base_path,remote_dir])).split('\n')
-    if copy_file_list[0]: created_list += [file.split(' ')[2][1:-1] for file in copy_file_list if file]
-
-    #cleanup any tmp staging dir
-    if staging_dir <> local_dir:
-        shutil.rmtree(staging_dir,ignore_errors=True)
+    #copy newer files from the staging to the destination and keep a list.
+    #rsync replaces files rather than writing into them so files hard linked
+    #between versions are never changed in place
+    options = ["rsync -rlptu --itemize-changes"]
+    if link_dest and link_dest <> remote_dir and exists(link_dest):
+        #itemize the unchanged files too so the files linked from link_dest are listed
+        options.append('--itemize-changes --link-dest=%s'% link_dest)
+    remote_base_path = '/'.join([remote_staging_dir,staging_name,''])
+    copy_file_list = func(' '.join(options + [remote_base_path,remote_dir])).split('\n')
+    invalidate(remote_dir)
+    created_list += ['/'.join([remote_dir,file]) for file in _itemized_files(copy_file_list)]
     
     return created_list
 
@@ -156,6 +454,7 @@ def mkdirs(remote_dir, use_sudo=False):
     result = func(' '.join(['mkdir -pv',remote_dir])).split('\n')
     #extract dir list from ["mkdir: created directory `example.com/some/dir'"]
     if result[0]: result = [dir.split(' ')[3][1:-1] for dir in result if dir]
+    invalidate(remote_dir, *result)
     return result
 
 def upload_template(filename,  destination,  context={},  use_sudo=False, backup=True, modified_only=False):
@@ -189,7 +488,7 @@ def upload_template(filename,  destination,  context={},  use_sudo=False, backup
         hashfile_path = os.path.join(hashfile_dir, hashfile)
         hashed = sha1(text).hexdigest()
         if hashfile:
-            if not exists(hashfile_dir): sudo('mkdir -p %s'% hashfile_dir)
+            if not exists(hashfile_dir): mkdirs(hashfile_dir, use_sudo=True)
             sudo('touch %s'% hashfile_path) #store the hash near the template
             previous_hashed = sudo('cat %s'% hashfile_path).strip()
             if previous_hashed == hashed:
@@ -224,4 +523,5 @@ def upload_template(filename,  destination,  context={},  use_sudo=False, backup
             _backup_file(to_backup)
     # Actually move uploaded template to destination
     func("mv %s %s" % (temp_destination, destination))
+    invalidate(destination)
     return True
\ No newline at end of file
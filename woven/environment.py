@@ -1,12 +1,12 @@
 #!/usr/bin/env python
-import json, os, string, sys, tempfile
+import base64, json, os, shutil, string, sys, tarfile, tempfile
 from contextlib import nested
 from distutils.core import run_setup
 
 from django.utils.importlib import import_module
 
 from fabric.context_managers import settings as fab_settings
-from fabric.context_managers import _setenv, cd
+from fabric.context_managers import _setenv, cd, hide
 from fabric.contrib.files import exists, comment, sed, append
 from fabric.decorators import runs_once, hosts
 from fabric.main import find_fabfile
@@ -14,6 +14,8 @@ from fabric.network import normalize
 from fabric.operations import local, run, sudo, prompt, get, put
 from fabric.state import _AttributeDict, env, output
 from fabric.version import get_version
+
+from woven.network import connection_pool
         
 
 woven_env = _AttributeDict({
@@ -23,6 +25,8 @@ woven_env = _AttributeDict({
 'HOST_USER':'', #optional - can be used in place of defining it elsewhere (ie host_string)
 'HOST_PASSWORD':'',#optional
 'SSH_KEY_FILENAME':'',#optional - as per fabric, a path to a key to use in place your local .ssh key 
+'SSH_KEEPALIVE':30, #optional - seconds between keepalives on pooled ssh connections. 0 to disable
+'SSH_MULTIPLEX':True, #optional - share one local ssh master connection per host between rsync calls
 
 #The first setup task is usually disabling the default root account and changing the ssh port.
 'ROOT_USER':'root', #optional - mostly the default administrative account is root
@@ -53,24 +57,101 @@ woven_env = _AttributeDict({
 'APACHE_DISABLE_MODULES':['alias','auth_basic','authn_file','authz_default','authz_groupfile',
                           'authz_user','autoindex','cgid','dir',
                           'setenvif','status'], 
+#Apache and mod_wsgi. Values of 0 are sized from each host's cpus, memory and apache sites
+'WSGI_PROCESSES':0, #daemon processes per site
+'WSGI_THREADS':15,
+'WSGI_MAXIMUM_REQUESTS':10000,
+'WSGI_PROCESS_MEMORY':64, #megabytes allowed per daemon process when sizing
+'APACHE_RESERVED_MEMORY':256, #megabytes left for everything else when sizing
+'APACHE_START_SERVERS':0,
+'APACHE_MAX_CLIENTS':0,
+'APACHE_KEEPALIVE':False, #nginx keeps the client connections alive
+'ROLE_APACHE':{}, #optional - APACHE_ and WSGI_ settings per role eg {'app':{'WSGI_PROCESSES':4}}
 #Specify a linux base backend to use. Not yet implemented
 #'LINUX_BASE':'debian',
 
 #define a list of repositories/sources to search for packages
 'LINUX_PACKAGE_REPOSITORIES':[], # eg ppa:bchesneau/gunicorn
+
+#optional - a ROLEDEFS role whose first host runs an apt-cacher-ng package cache for all the other nodes
+'PACKAGE_CACHE_ROLE':'',
+'PACKAGE_CACHE_HOST':'', #optional - an existing apt proxy to use instead eg 192.168.188.1
+'PACKAGE_CACHE_PORT':3142,
+'PACKAGE_CACHE_ALLOW':[], #optional - addresses or networks allowed to use the cache eg ['10.0.0.0/8']. Defaults to the nodes
     
 #Virtualenv/Pip
 'DEPLOYMENT_ROOT':'',
+'DEPLOY_FILES_MANIFEST':False, #optional - only send the files that changed since the last deploy to a directory
 'PROJECT_APPS_PATH':'',#a relative path from the project package directory for any local apps
 'PIP_REQUIREMENTS':[], #a list of pip requirement and or pybundle files to use for installation
+'PIP_INCREMENTAL':False, #optional - clone the active virtualenv and only install the requirements that changed
+'PIP_CACHE_ROOT':'', #optional - defaults to /home/$USER/.pip
+'PIP_CACHE_MAX_SIZE':512, #megabytes of downloads and checkouts to keep in the pip cache. 0 for no limit
 
 #Application media
 'STATIC_URL':'', #optional
 'STATIC_ROOT':'', #optional
+'STATIC_PIPELINE':False, #optional - deploy fingerprinted and precompressed copies of the static files as well
+'STATIC_PIPELINE_BROTLI':False, #optional - also precompress with brotli. Requires the brotli module
+
+#Gunicorn. Workers and threads of 0 are sized from each host's cpus and memory
+'GUNICORN_WORKERS':0,
+'GUNICORN_WORKER_CLASS':'', #optional - defaults to sync. eg gevent, eventlet, tornado or gthread
+'GUNICORN_THREADS':0, #gthread worker class only
+'GUNICORN_WORKER_CONNECTIONS':0, #optional - async worker classes only
+'GUNICORN_WORKER_MEMORY':64, #megabytes allowed per worker when sizing
+'GUNICORN_RESERVED_MEMORY':256, #megabytes left for everything else when sizing
+'GUNICORN_KEEPALIVE':0, #optional - seconds
+'GUNICORN_BACKLOG':0, #optional
+'GUNICORN_TIMEOUT':0, #optional - seconds
+'GUNICORN_MAX_REQUESTS':0, #optional - restart workers after this many requests
+'GUNICORN_MAX_REQUESTS_JITTER':0, #optional - spread the restarts
+'GUNICORN_LOG_LEVEL':'info',
+'ROLE_GUNICORN':{}, #optional - GUNICORN_ settings per role eg {'app':{'GUNICORN_WORKERS':8}}
+'SITE_GUNICORN':{}, #optional - GUNICORN_ settings per sitesettings module eg {'admin_settings':{'GUNICORN_WORKERS':2}}
+
+#Nginx proxying to the backend
+'NGINX_UPSTREAM_SOCKET':False, #optional - gunicorn only. Proxy over a unix socket instead of tcp
+'NGINX_UPSTREAM_KEEPALIVE':0, #optional - idle backend connections kept open per nginx worker. Requires nginx 1.1.4+
+'NGINX_PROXY_BUFFERING':True,
+'NGINX_PROXY_BUFFER_SIZE':'4k',
+'NGINX_PROXY_BUFFERS':'32 4k',
+'NGINX_PROXY_BUSY_BUFFERS_SIZE':'8k',
+
+#Nginx proxy cache for anonymous requests
+'NGINX_PROXY_CACHE':False, #optional - cache backend responses for a short time
+'NGINX_PROXY_CACHE_TTL':'10s',
+'NGINX_PROXY_CACHE_ZONE_SIZE':'10m', #shared memory for the cache keys
+'NGINX_PROXY_CACHE_MAX_SIZE':'256m', #disk space
+'NGINX_PROXY_CACHE_BYPASS_COOKIES':['sessionid'], #requests with these cookies are never cached
+'SITE_PROXY_CACHES':{}, #optional - NGINX_PROXY_CACHE_ settings per domain eg {'example.com':{'NGINX_PROXY_CACHE':True}}
+
+#Nginx static and media serving
+'NGINX_STATIC_PROFILE':False, #optional - add caching headers and file caching to the static and media locations
+'NGINX_STATIC_EXPIRES':'max', #for STATIC_URL. Use a shorter time if your static file names are not versioned
+'NGINX_STATIC_MEDIA_EXPIRES':'7d', #for MEDIA_URL
+'NGINX_STATIC_OPEN_FILE_CACHE':'max=2000 inactive=60s',
+'NGINX_STATIC_GZIP':True, #serve precompressed .gz files where they exist
+'NGINX_STATIC_SENDFILE_MAX_CHUNK':'512k',
+'SITE_STATIC_PROFILES':{}, #optional - NGINX_STATIC_ settings per domain eg {'example.com':{'NGINX_STATIC_EXPIRES':'1h'}}
 
 #Database migrations
 'MANUAL_MIGRATION':False, #optional Manage database migrations manually
 
+#Activation
+'GRACEFUL_RELOAD':True, #optional - keep serving the old version while activating and reload the webservers gracefully
+'BLUE_GREEN':False, #optional - start the new version on the alternate backend port and cut nginx over once it is healthy
+'BLUE_GREEN_GRACE':30, #seconds the previous version has to finish its requests before it is stopped
+'WARMUP_URLS':[], #optional - paths requested on the new version before blue/green cut over, or a domain:[paths] dict
+'WARMUP_REQUESTS':3, #number of timed rounds of the warm up urls
+'WARMUP_MAX_REGRESSION':0.5, #refuse to activate if the 95th percentile is this fraction slower than the active version. 0 to disable
+
+#Rolling activation (--rolling)
+'ROLLING_BATCH_SIZE':1, #number or percentage of a role's hosts to activate at a time eg 2 or '25%'
+'ROLLING_MAX_UNAVAILABLE':'', #optional - number or percentage of a role's hosts that can be out of service at once
+'HEALTH_CHECK_URL':'/', #path requested on each domain after activation
+'HEALTH_CHECK_TIMEOUT':60, #seconds to wait for a host to pass the health check
+
 })
 
 def _parse_project_version(version=''):
@@ -348,6 +429,10 @@ def set_env(settings=None, setup_dir=''):
             role_lookup[host_string] = ''
     env.role_lookup = role_lookup
     env.hosts = role_lookup.keys()
+    #setup the package cache host before the nodes that use it
+    cache_host = package_cache_host()
+    if cache_host:
+        env.hosts.sort(key=lambda h: normalize(h)[1] <> cache_host)
     
     #remove any unneeded db adaptors - except sqlite
     remove_backends = ['postgresql_psycopg2', 'mysql']
@@ -445,13 +530,56 @@ def set_env(settings=None, setup_dir=''):
     #Sites
     env.sites = {}
     env.shell = '/bin/bash --noprofile -l -c'
+    
+    #keep one live ssh connection per user, host and port for the whole command
+    connection_pool()
     #output.debug = True
 
+def _host_count(value, total):
+    """
+    Convert a count or a percentage string ('25%') of ``total`` hosts
+    into a number of hosts, never less than one
+    """
+    value = str(value).strip()
+    if value.endswith('%'):
+        count = total * int(value[:-1]) // 100
+    else:
+        count = int(value)
+    return max(count, 1)
+
+def rolling_batches(hosts, batch_size=1, max_unavailable=''):
+    """
+    Split ``hosts`` into batches per role as defined in ``env.role_lookup``.
+    
+    ``batch_size`` and ``max_unavailable`` can be a number or a percentage
+    of the hosts in the role. The batch size is capped by max_unavailable.
+    
+    Returns a list of (role, [host, ...]) tuples
+    """
+    roles = {}
+    for host in hosts:
+        role = env.role_lookup.get(host,'')
+        roles[role] = roles.get(role,[]) + [host]
+    role_names = roles.keys()
+    role_names.sort()
+    batches = []
+    for role in role_names:
+        role_hosts = roles[role]
+        size = _host_count(batch_size, len(role_hosts))
+        if max_unavailable:
+            size = min(size, _host_count(max_unavailable, len(role_hosts)))
+        for i in range(0, len(role_hosts), size):
+            batches.append((role, role_hosts[i:i+size]))
+    return batches
+
 def get_packages():
     """
     per host list of packages
     """
     packages = env.packages[env.role_lookup[env.host_string]]
+    #the package cache host runs apt-cacher-ng
+    if is_package_cache_host() and 'apt-cacher-ng' not in packages:
+        packages = packages + ['apt-cacher-ng']
     return packages
     
 def patch_project():
@@ -584,33 +712,172 @@ def set_server_state(name,object=None,delete=False):
         return set_version_state(name,object,delete)
 
 
+#Server states are kept in a single manifest per host. States with large
+#content (eg lists of deployed files) are kept in a file per state as
+#woven has always done, and only fetched if they are read.
+STATE_PATH = '/var/local/woven'
+STATE_MANIFEST = '.manifest'
+STATE_INLINE_SIZE = 4096
+
+#Reads the manifest, or on the first run after an upgrade the existing state files
+STATE_SCRIPT = """
+import json, os, sys
+path, manifest, inline_size = sys.argv[1], sys.argv[2], int(sys.argv[3])
+states = {}
+files = []
+if os.path.exists(os.path.join(path, manifest)):
+    m = json.load(open(os.path.join(path, manifest)))
+    states, files = m['states'], m['files']
+elif os.path.isdir(path):
+    for name in os.listdir(path):
+        filename = os.path.join(path, name)
+        if name.startswith('.') or not os.path.isfile(filename): continue
+        size = os.path.getsize(filename)
+        if size > inline_size:
+            files.append(name)
+            continue
+        states[name] = None
+        if size:
+            try:
+                states[name] = json.loads(open(filename).read())
+            except ValueError:
+                pass
+print json.dumps({'states':states, 'files':files})
+"""
+
+#per host state cache
+_state_stores = {}
+
+def package_cache_host():
+    """
+    The host of the apt package cache for the nodes or ''
+    """
+    if env.PACKAGE_CACHE_HOST:
+        return env.PACKAGE_CACHE_HOST.split(':')[0]
+    hosts = env.roledefs.get(env.PACKAGE_CACHE_ROLE or None)
+    if hosts: return normalize(hosts[0])[1]
+    return ''
+
+def is_package_cache_host():
+    """
+    True if the current host is the first host of the PACKAGE_CACHE_ROLE
+    and no other PACKAGE_CACHE_HOST is defined
+    """
+    if not env.PACKAGE_CACHE_ROLE or env.PACKAGE_CACHE_HOST: return False
+    return normalize(env.host_string)[1] == package_cache_host()
+
+def remote_python(script, *args, **kwargs):
+    """
+    Run a python ``script`` on the host in a single round trip,
+    as root with ``use_sudo=True``. Scripts run with the node's
+    python so they must stay compatible with python 2.6
+    
+    Returns the output. Scripts should print their result on the last line
+    """
+    func = kwargs.get('use_sudo') and sudo or run
+    script = base64.b64encode(script)
+    args = ' '.join(["'%s'"% a for a in args])
+    with fab_settings(hide('running','stdout'), warn_only=True):
+        output = func('echo %s | base64 -d | python - %s'% (script, args))
+    return output
+
+def _state_store():
+    """
+    The states for the current host, fetched once per command
+    """
+    host = normalize(env.host_string)[1]
+    if host not in _state_stores:
+        output = remote_python(STATE_SCRIPT, STATE_PATH, STATE_MANIFEST, str(STATE_INLINE_SIZE))
+        if output.failed:
+            print env.host, "ERROR: Could not read the woven server states"
+            print output
+            sys.exit(1)
+        manifest = json.loads(output.split('\n')[-1])
+        _state_stores[host] = _AttributeDict({'states':manifest['states'],
+                                              'files':set(manifest['files']),
+                                              'deleted':set(),
+                                              'changed':False})
+    return _state_stores[host]
+
+def flush_states():
+    """
+    Write any changed states for the current host back to the server in one batch
+    and clear the cached states. The management commands flush after each host,
+    but fabfiles that set states should call it when they are done with a host.
+    """
+    host = normalize(env.host_string)[1]
+    store = _state_stores.pop(host, None)
+    if not store or not store.changed: return
+    
+    states = {}
+    files = set([name for name in store.files if name not in store.states])
+    staging_dir = tempfile.mkdtemp()
+    for name, object in store.states.items():
+        content = json.dumps(object)
+        if object is not None and len(content) > STATE_INLINE_SIZE:
+            f = open(os.path.join(staging_dir, name),'w')
+            f.write(content)
+            f.close()
+            files.add(name)
+        else:
+            states[name] = object
+    f = open(os.path.join(staging_dir, STATE_MANIFEST),'w')
+    f.write(json.dumps({'states':states, 'files':sorted(files)}))
+    f.close()
+    
+    fd, archive = tempfile.mkstemp(suffix='.tar.gz')
+    os.close(fd)
+    tar = tarfile.open(archive, 'w:gz')
+    for name in os.listdir(staging_dir):
+        tar.add(os.path.join(staging_dir, name), name)
+    tar.close()
+    remote_archive = '/tmp/woven-states-%s.tar.gz'% env.user
+    put(archive, remote_archive)
+    os.remove(archive)
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    
+    commands = ['mkdir -p %s'% STATE_PATH,
+                'tar --no-same-owner -xzf %s -C %s'% (remote_archive, STATE_PATH),
+                'rm -f %s'% remote_archive]
+    #per state files from before the manifest are ignored once it exists,
+    #but deleted states may still have one
+    if store.deleted:
+        commands.append('rm -f %s'% ' '.join(["'%s/%s'"% (STATE_PATH, name) for name in store.deleted]))
+    sudo(' && '.join(commands))
+    
 def set_version_state(name,object=None,delete=False):
     """
-    Sets a simple 'state' on the server by creating a file
-    with the desired state's name + version and storing ``content`` as json strings if supplied
+    Sets a simple 'state' on the server with the desired state's name + version
+    and storing ``object`` as json if supplied. States are cached and written
+    to the server by flush_states.
     
-    returns the filename used to store state   
+    returns the name used to store state   
     """
     if env.project_fullname: state_name = '-'.join([env.project_fullname,name])
     else: state_name = name
-    with fab_settings(warn_only=True):
-        #Test for os state
-        if not exists('/var/local/woven', use_sudo=True):
-            sudo('mkdir /var/local/woven')
+    store = _state_store()
     if not delete:
-        sudo('touch /var/local/woven/%s'% state_name)
-        if object <> None:
-            fd, file_path = tempfile.mkstemp()
-            f = os.fdopen(fd,'w')
-            f.write(json.dumps(object))
-            f.close()
-            put(file_path,'/tmp/%s'% state_name)
-            os.remove(file_path)
-            sudo('cp /tmp/%s /var/local/woven/%s'% (state_name,state_name))
+        #as with touch, setting a state without an object keeps any existing object
+        if object <> None or (state_name not in store.states and state_name not in store.files):
+            store.states[state_name] = object
+            store.files.discard(state_name)
     else:
-        sudo('rm -f /var/local/woven/%s'% state_name)
+        store.states.pop(state_name, None)
+        store.files.discard(state_name)
+        store.deleted.add(state_name)
+    store.changed = True
     return state_name
-    
+
+def delete_version_states():
+    """
+    Delete all states for ``env.project_fullname``
+    """
+    store = _state_store()
+    prefix = env.project_fullname + '-'
+    for state_name in set(store.states.keys()) | store.files:
+        if state_name.startswith(prefix):
+            with fab_settings(project_fullname=''):
+                set_version_state(state_name, delete=True)
 
 def server_state(name, no_content=False):
     """
@@ -624,31 +891,22 @@ def server_state(name, no_content=False):
 def version_state(name, prefix=False, no_content=False):
     """
     If the server state exists return parsed json as a python object or True 
-    prefix=True returns True if any files exist with ls [prefix]*
+    prefix=True returns True if any states exist ending with the name
     """
     if env.project_fullname: full_name = '-'.join([env.project_fullname,name])
     else: full_name = name
-    current_state = False
-    state = State(full_name)
-    state_path = '/var/local/woven/%s'% full_name
-    if not prefix and not no_content and exists(state_path):
-        content = int(sudo('ls -s %s'% state_path).split()[0]) #get size
-        if content:
-            fd, file_path = tempfile.mkstemp()
-            os.close(fd)
-            get(state_path,file_path)
-            with open(file_path, "r") as f:
-                content = f.read()
-                object = json.loads(content)
-                current_state = object
-        else:
-            current_state = True
-    elif not prefix and no_content and exists(state_path):
-        current_state = True
-    elif prefix:
-        with fab_settings(warn_only=True): #find any version
-            current_state = sudo('ls /var/local/woven/*%s'% name)
-        if not current_state.failed:current_state = True
-      
+    store = _state_store()
+    if prefix:
+        return bool([s for s in set(store.states.keys()) | store.files if s.endswith(name)])
+    if full_name in store.states:
+        current_state = store.states[full_name]
+    elif full_name in store.files:
+        if no_content: return True
+        #large content is kept in the state file
+        with fab_settings(hide('running','stdout')):
+            content = sudo('cat %s/%s'% (STATE_PATH, full_name), pty=False)
+        current_state = store.states[full_name] = json.loads(content)
+    else:
+        return False
+    if current_state is None or no_content: return True
     return current_state
-   
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+"""
+Host facts gathered in a single round trip.
+
+The first time a fact is needed for a host woven lists the directories it
+checks for existence, reads the small files it greps, and runs the commands
+whose output it parses (dpkg, lsb_release, python -V, cpus, memory) in one remote python
+run. exists, contains and the helpers here answer from that cache, and
+anything the probe didn't cover falls back to a normal remote call.
+
+Functions that change the host through woven invalidate the paths they touch.
+"""
+import base64, json, posixpath, re
+from functools import wraps
+
+from fabric.state import _AttributeDict, env
+from fabric.operations import run, sudo
+from fabric.network import normalize
+from fabric.contrib import files
+
+from woven.environment import deployment_root, remote_python
+
+#Commands whose output is kept as a fact
+FACT_COMMANDS = {
+'packages':"dpkg-query -W -f='${Status} ${Package}\\n'",
+'lsb_release':'lsb_release -a',
+'python_version':'python -V',
+'machine':'uname -m',
+'cpu_count':'grep -c ^processor /proc/cpuinfo',
+'memory':'grep MemTotal /proc/meminfo',
+}
+
+#Collects the command output, listings and file contents in the spec
+FACTS_SCRIPT = r"""
+import base64, json, os, subprocess, sys
+spec = json.loads(base64.b64decode(sys.argv[1]))
+facts = {'commands':{}, 'dirs':{}, 'links':{}, 'files':{}}
+for name, command in spec['commands'].items():
+    p = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    out = p.communicate()[0]
+    if not p.returncode: facts['commands'][name] = out.strip().decode('utf-8','replace')
+def listdir(path, depth):
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return
+    #as per test -e broken links don't exist
+    names = [n for n in names if os.path.exists(os.path.join(path, n))]
+    facts['dirs'][path] = names
+    for n in names:
+        child = os.path.join(path, n)
+        if os.path.islink(child):
+            facts['links'][child] = os.readlink(child)
+        elif (depth is None or depth > 1) and os.path.isdir(child):
+            listdir(child, depth and depth - 1)
+for path, depth in spec['dirs']:
+    listdir(path, depth)
+for path in spec['files']:
+    try:
+        if os.path.getsize(path) < 65536:
+            facts['files'][path] = open(path).read().decode('utf-8','replace')
+    except (IOError, OSError):
+        pass
+print json.dumps(facts)
+"""
+
+#per host facts
+_host_facts = {}
+
+def _probe_dirs():
+    """
+    Directories listed by the probe as (path, depth), with ``None`` for all levels
+    """
+    root = deployment_root()
+    return [('/', 1), ('/etc', 1), ('/var/local', 1), ('/var/www', 1),
+            ('/var/local/woven-backup', None),
+            ('/etc/apache2/sites-available', 1), ('/etc/apache2/sites-enabled', 1),
+            ('/etc/nginx/sites-available', 1), ('/etc/nginx/sites-enabled', 1),
+            (posixpath.dirname(root), 1), (root, 1),
+            ('/'.join([root,'.ssh']), 1), ('/'.join([root,'.staging']), 1),
+            ('/'.join([root,'env']), 1), ('/'.join([root,'database']), 1)]
+
+def _probe_files():
+    """
+    Small files that woven reads or greps
+    """
+    return ['/etc/passwd', '/etc/group', '/etc/timezone', '/etc/apt/sources.list',
+            '/etc/ssh/sshd_config', '/home/%s/.profile'% env.user]
+
+def host_facts():
+    """
+    The facts for the current host, gathered on first use
+    """
+    host = normalize(env.host_string)[1]
+    if host not in _host_facts:
+        spec = {'commands':FACT_COMMANDS, 'dirs':_probe_dirs(), 'files':_probe_files()}
+        output = remote_python(FACTS_SCRIPT, base64.b64encode(json.dumps(spec)))
+        facts = _AttributeDict({'commands':{}, 'dirs':{}, 'links':{}, 'files':{}})
+        if output.succeeded:
+            try:
+                facts.update(json.loads(output.split('\n')[-1]))
+            except ValueError:
+                pass
+        elif env.verbosity:
+            print env.host, "WARNING: Could not gather host facts"
+        facts.dirs = dict([(path, set(names)) for path, names in facts.dirs.items()])
+        _host_facts[host] = facts
+    return _host_facts[host]
+
+def clear_facts():
+    """
+    Forget the facts for the current host
+    """
+    _host_facts.pop(normalize(env.host_string)[1], None)
+
+def invalidate(*paths):
+    """
+    Forget what is known about remote ``paths`` and anything below them.
+
+    Call with no paths after changes to unknown paths such as package installs
+    """
+    host = normalize(env.host_string)[1]
+    facts = _host_facts.get(host)
+    if not facts: return
+    if not paths:
+        facts.dirs.clear(); facts.links.clear(); facts.files.clear()
+        return
+    for path in paths:
+        if not path or not path.startswith('/'): continue
+        path = posixpath.normpath(path)
+        below = path.rstrip('/') + '/'
+        for d in facts.dirs.keys():
+            if d == path or d.startswith(below): del facts.dirs[d]
+        #the listing of the parent may have changed too
+        facts.dirs.pop(posixpath.dirname(path), None)
+        for cache in (facts.links, facts.files):
+            for p in cache.keys():
+                if p == path or p.startswith(below): del cache[p]
+
+def invalidate_fact(*names):
+    """
+    Forget the output of the FACT_COMMANDS ``names``
+    """
+    facts = _host_facts.get(normalize(env.host_string)[1])
+    if not facts: return
+    for name in names:
+        facts.commands.pop(name, None)
+
+def command_fact(name):
+    """
+    The output of one of the FACT_COMMANDS
+    """
+    facts = host_facts()
+    if name not in facts.commands:
+        facts.commands[name] = run(FACT_COMMANDS[name])
+    return facts.commands[name]
+
+def package_status():
+    """
+    A package:dpkg status dictionary eg {'nginx':'install ok installed'}
+    """
+    status = {}
+    for line in command_fact('packages').split('\n'):
+        parts = line.split()
+        if len(parts) > 1: status[parts[-1]] = ' '.join(parts[:-1])
+    return status
+
+def installed_packages():
+    """
+    A list of installed packages
+    """
+    return [package for package, status in package_status().items() if status == 'install ok installed']
+
+def exists(path, use_sudo=False, verbose=False):
+    """
+    As per fabric ``exists``, but answers from the host facts where it can
+    """
+    if path and path.startswith('/'):
+        facts = host_facts()
+        path = posixpath.normpath(path)
+        if path in facts.dirs: return True
+        parent, name = posixpath.split(path)
+        if parent in facts.dirs: return name in facts.dirs[parent]
+    return files.exists(path, use_sudo=use_sudo, verbose=verbose)
+
+def readlink(path):
+    """
+    The target of a symlink if it is known from the host facts, otherwise None
+    """
+    return host_facts().links.get(posixpath.normpath(path))
+
+def read_file(path, use_sudo=False):
+    """
+    The contents of a remote file
+    """
+    facts = host_facts()
+    path = posixpath.normpath(path)
+    if path not in facts.files:
+        func = use_sudo and sudo or run
+        facts.files[path] = func('cat %s'% path)
+    return facts.files[path]
+
+def ls(path):
+    """
+    A list of the names in a remote directory
+    """
+    facts = host_facts()
+    path = posixpath.normpath(path)
+    if path in facts.dirs: return sorted(facts.dirs[path])
+    return [name for name in run('ls %s'% path).split('\n') if name]
+
+def contains(filename, text, exact=False, use_sudo=False):
+    """
+    As per fabric ``contains``, but answers from the host facts where it can
+    """
+    content = host_facts().files.get(posixpath.normpath(filename))
+    if content is not None:
+        pattern = exact and '^%s$'% text or text
+        try:
+            return bool(re.search(pattern, content, re.M))
+        except re.error:
+            pass
+    return files.contains(filename=filename, text=text, exact=exact, use_sudo=use_sudo)
+
+def _invalidates(func):
+    """
+    Wrap a fabric.contrib.files function so the file it changes is invalidated
+    """
+    @wraps(func)
+    def decorated(*args, **kwargs):
+        result = func(*args, **kwargs)
+        invalidate(kwargs.get('filename', args and args[0]))
+        return result
+    return decorated
+
+append = _invalidates(files.append)
+comment = _invalidates(files.comment)
+uncomment = _invalidates(files.uncomment)
+sed = _invalidates(files.sed)
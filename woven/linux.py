@@ -12,12 +12,13 @@ from django.utils import importlib
 from fabric.state import  _AttributeDict, env, connections
 from fabric.context_managers import settings, hide
 from fabric.operations import prompt, run, sudo, get, put
-from fabric.contrib.files import comment, uncomment, contains, exists, append, sed
 from fabric.contrib.console import confirm
 from fabric.network import join_host_strings, normalize
 
-from woven.deployment import _backup_file, _restore_file, deploy_files, upload_template
-from woven.environment import server_state, set_server_state, get_packages
+from woven.deployment import _backup_file, _restore_file, batch, deploy_files, upload_template
+from woven.facts import comment, uncomment, contains, exists, append, sed
+from woven.facts import command_fact, installed_packages, invalidate, invalidate_fact, package_status
+from woven.environment import server_state, set_server_state, get_packages, package_cache_host, is_package_cache_host
 
 def _get_template_files(template_dir):
     etc_dir = os.path.join(template_dir,'woven','etc')
@@ -31,11 +32,41 @@ def _get_template_files(template_dir):
 
     return set(templates)
 
+APT_PROXY_CONF = '/etc/apt/apt.conf.d/01proxy-woven'
+
+def set_package_cache():
+    """
+    Point apt at the package cache defined by PACKAGE_CACHE_ROLE or PACKAGE_CACHE_HOST
+    so the nodes only download each package once.
+    
+    The cache host itself and nodes that can't reach the cache use the mirrors directly
+    """
+    cache_host = package_cache_host()
+    proxy = ''
+    if cache_host and cache_host <> normalize(env.host_string)[1]:
+        with settings(hide('warnings','running','stdout','stderr'),warn_only=True):
+            reachable = run("python -c \"import socket; socket.create_connection(('%s',%s),5)\""%
+                            (cache_host, env.PACKAGE_CACHE_PORT)).succeeded
+        if reachable:
+            proxy = 'http://%s:%s'% (cache_host, env.PACKAGE_CACHE_PORT)
+        else:
+            print env.host, "WARNING: The package cache at %s:%s is not reachable"% (cache_host, env.PACKAGE_CACHE_PORT)
+    if proxy == (server_state('package_cache') or ''): return
+    if proxy:
+        if env.verbosity:
+            print env.host, "USING PACKAGE CACHE", proxy
+        sudo("""echo 'Acquire::http::Proxy "%s";' > %s"""% (proxy, APT_PROXY_CONF))
+    else:
+        sudo('rm -f %s'% APT_PROXY_CONF)
+    invalidate(APT_PROXY_CONF)
+    set_server_state('package_cache',proxy)
+
 def add_repositories():
     """
     Adds additional sources as defined in LINUX_PACKAGE_REPOSITORIES.
 
     """
+    set_package_cache()
     if not env.overwrite and env.LINUX_PACKAGE_REPOSITORIES == server_state('linux_package_repositories'): return
     if env.verbosity:
         print env.host, "UNCOMMENTING SOURCES in /etc/apt/sources.list and adding PPAs"
@@ -48,6 +79,7 @@ def add_repositories():
         sudo('add-apt-repository %s'% p)
         if env.verbosity:
             print 'added source', p
+    invalidate('/etc/apt')
     set_server_state('linux_package_repositories',env.LINUX_PACKAGE_REPOSITORIES)
 
 def add_user(username='',password='',group='', site_user=False):
@@ -64,6 +96,7 @@ def add_user(username='',password='',group='', site_user=False):
     else:
         sudo('useradd -M -d /var/www -s /bin/bash %s'% username)
         sudo('usermod -a -G www-data %s'% username)    
+    invalidate('/etc/passwd','/etc/group','/home/%s'% username)
 
 def change_ssh_port():
     """
@@ -130,9 +163,11 @@ def disable_root():
     with settings(host_string=host_string, key_filename=env.key_filename, password=env.ROOT_PASSWORD):
         if not contains('/etc/group','sudo',use_sudo=True):
             sudo('groupadd sudo')
+            invalidate('/etc/group')
 
         home_path = '/home/%s'% sudo_user
-        if not exists(home_path):
+        new_user = not exists(home_path)
+        if new_user:
             if env.verbosity:
                 print env.host, 'CREATING A NEW ACCOUNT WITH SUDO PRIVILEGE: %s'% sudo_user
             if not original_password:
@@ -141,24 +176,28 @@ def disable_root():
             
             add_user(username=sudo_user, password=original_password,group='sudo')
 
-        #Add existing user to sudo group
-        else:
-            sudo('adduser %s sudo'% sudo_user)
-        #adm group used by Ubuntu logs
-        sudo('usermod -a -G adm %s'% sudo_user)
-        #add user to /etc/sudoers
-        if not exists('/etc/sudoers.wovenbak',use_sudo=True):
-            sudo('cp -f /etc/sudoers /etc/sudoers.wovenbak')
-        sudo('cp -f /etc/sudoers /tmp/sudoers.tmp')
-        append('/tmp/sudoers.tmp', "# Members of the sudo group may gain root privileges", use_sudo=True)
-        append('/tmp/sudoers.tmp', "%sudo ALL=(ALL) NOPASSWD:ALL",  use_sudo=True)
-        sudo('visudo -c -f /tmp/sudoers.tmp')
-        sudo('cp -f /tmp/sudoers.tmp /etc/sudoers')
-        sudo('rm -rf /tmp/sudoers.tmp')
-        if env.key_filename:
-            sudo('mkdir -p /home/%s/.ssh'% sudo_user)
-            sudo('cp -f ~/.ssh/authorized_keys /home/%s/.ssh/authorized_keys'% sudo_user)
-            sudo('chown -R %s:sudo /home/%s/.ssh'% (sudo_user,sudo_user))
+        with batch(use_sudo=True) as commands:
+            #Add existing user to sudo group
+            if not new_user:
+                commands.add('adduser %s sudo'% sudo_user)
+            #adm group used by Ubuntu logs
+            commands.add('usermod -a -G adm %s'% sudo_user)
+            #add user to /etc/sudoers
+            if not exists('/etc/sudoers.wovenbak',use_sudo=True):
+                commands.add('cp -f /etc/sudoers /etc/sudoers.wovenbak')
+            commands.add('cp -f /etc/sudoers /tmp/sudoers.tmp')
+            #append each line once
+            for line in ["# Members of the sudo group may gain root privileges",
+                         "%sudo ALL=(ALL) NOPASSWD:ALL"]:
+                commands.add("grep -qxF '%s' /tmp/sudoers.tmp || echo '%s' >> /tmp/sudoers.tmp"% (line, line))
+            commands.add('visudo -c -f /tmp/sudoers.tmp')
+            commands.add('cp -f /tmp/sudoers.tmp /etc/sudoers')
+            commands.add('rm -rf /tmp/sudoers.tmp')
+            if env.key_filename:
+                commands.add('mkdir -p /home/%s/.ssh'% sudo_user)
+                commands.add('cp -f ~/.ssh/authorized_keys /home/%s/.ssh/authorized_keys'% sudo_user)
+                commands.add('chown -R %s:sudo /home/%s/.ssh'% (sudo_user,sudo_user))
+        invalidate('/etc/group','/etc/sudoers.wovenbak','/home/%s/.ssh'% sudo_user)
             
     env.password = original_password
 
@@ -176,12 +215,16 @@ def disable_root():
 
     return True
 
-def install_package(package):
+def install_package(*packages):
     """
-    apt-get install [package]
+    apt-get install [package ...] in one transaction
     """
     #install silent and answer yes by default -qqy
-    sudo('apt-get install -qqy %s'% package, pty=True)
+    result = sudo('apt-get install -qqy %s'% ' '.join(packages), pty=True)
+    #packages can change anything
+    invalidate()
+    invalidate_fact('packages')
+    return result
     
 def install_packages():
     """
@@ -191,7 +234,7 @@ def install_packages():
     if env.verbosity:
         print env.host, "INSTALLING & CONFIGURING NODE PACKAGES:"
     #Get a list of installed packages
-    p = run("dpkg -l | awk '/ii/ {print $2}'").split('\n')
+    p = installed_packages()
     
     #Remove apparmor - TODO we may enable this later
     if env.overwrite or not server_state('apparmor-disabled') and 'apparmor' in p:
@@ -205,9 +248,15 @@ def install_packages():
     env.installed_packages[env.host] = []
     role = env.role_lookup[env.host_string]
     packages = get_packages()
-    for package in packages:
-        if not package in p:
-            install_package(package)
+    missing = [package for package in packages if not package in p]
+    if missing:
+        #resolve dependencies once for all the packages
+        with settings(warn_only=True):
+            install_package(*missing)
+        p = installed_packages()
+        for package in missing:
+            #install individually if the transaction failed so the failing package aborts
+            if not package in p: install_package(package)
             if env.verbosity:
                 print ' * installed',package
             env.installed_packages[env.host].append(package)
@@ -216,13 +265,12 @@ def install_packages():
         env.installed_packages[env.host] = packages
 
     if env.overwrite and 'apache2' in env.installed_packages[env.host]: 
-            #some sensible defaults -might move to putting this config in a template
-            sudo("rm -f /etc/apache2/sites-enabled/000-default")
-            sed('/etc/apache2/apache2.conf',before='KeepAlive On',after='KeepAlive Off',use_sudo=True, backup='')
-            sed('/etc/apache2/apache2.conf',before='StartServers          2', after='StartServers          1', use_sudo=True, backup='')
-            sed('/etc/apache2/apache2.conf',before='MaxClients          150', after='MaxClients          100', use_sudo=True, backup='')
-            for module in env.APACHE_DISABLE_MODULES:
-                sudo('rm -f /etc/apache2/mods-enabled/%s*'% module)
+            #the MPM settings are sized and rendered into conf.d on deploy
+            with batch(use_sudo=True) as commands:
+                commands.add("rm -f /etc/apache2/sites-enabled/000-default")
+                for module in env.APACHE_DISABLE_MODULES:
+                    commands.add('rm -f /etc/apache2/mods-enabled/%s*'% module)
+            invalidate('/etc/apache2')
     #Install base python packages
     #We'll use easy_install at this stage since it doesn't download if the package
     #is current whereas pip always downloads.
@@ -257,7 +305,7 @@ def lsb_release():
     
     """
     
-    output = run('lsb_release -a').split('\n')
+    output = command_fact('lsb_release').split('\n')
     release = _AttributeDict({})
     for line in output:
         try:
@@ -352,6 +400,7 @@ def set_timezone(rollback=False):
         _backup_file('/etc/timezone')
         sudo('echo %s > /tmp/timezone'% env.TIME_ZONE)
         sudo('cp -f /tmp/timezone /etc/timezone')
+        invalidate('/etc/timezone')
         sudo('dpkg-reconfigure --frontend noninteractive tzdata')
     else:
         _restore_fie('/etc/timezone')
@@ -367,8 +416,7 @@ def setup_ufw():
     ufw_state = server_state('ufw_installed')
     if ufw_state and not env.overwrite or ufw_state == str(env.HOST_SSH_PORT): return
     #check for actual package
-    ufw = run("dpkg -l | grep 'ufw' | awk '{print $2}'").strip()
-    if not ufw:
+    if not 'ufw' in installed_packages():
         if env.verbosity:
             print env.host, "INSTALLING & ENABLING FIREWALL ufw"
         install_package('ufw')
@@ -399,6 +447,21 @@ def setup_ufw():
     set_server_state('ufw_installed',str(env.HOST_SSH_PORT))
     return
 
+def _package_cache_sources():
+    """
+    The addresses allowed to use the package cache. Defaults to every node
+    in the command's hosts and ROLEDEFS
+    """
+    if env.PACKAGE_CACHE_ALLOW: return env.PACKAGE_CACHE_ALLOW
+    hosts = set([normalize(h)[1] for h in env.hosts + sum(env.roledefs.values(),[])])
+    return [socket.gethostbyname(h) for h in hosts]
+
+def package_cache_rules(sources, port):
+    """
+    ufw rules that open the package cache ``port`` to ``sources`` only
+    """
+    return ['allow from %s to any port %s proto tcp'% (source, port) for source in sorted(set(sources))]
+
 def setup_ufw_rules():
     """
     Setup ufw app rules from application templates and settings UFW_RULES
@@ -411,26 +474,27 @@ def setup_ufw_rules():
     else: current_rules = set([])
     role = env.role_lookup[env.host_string]
     firewall_rules = set(env.firewall_rules[role])
+    if is_package_cache_host():
+        firewall_rules |= set(package_cache_rules(_package_cache_sources(), env.PACKAGE_CACHE_PORT))
     if not env.overwrite and firewall_rules == current_rules: return
     if env.verbosity:
         print 'CONFIGURING FIREWALL'
     
     delete_rules = current_rules - firewall_rules
-    for rule in delete_rules:
-        with settings(warn_only=True):
+    new_rules = firewall_rules - current_rules        
+    with batch(use_sudo=True) as commands:
+        for rule in delete_rules:
             if env.verbosity:
                 print 'ufw delete', rule
-            sudo('ufw delete %s'% rule)
-    new_rules = firewall_rules - current_rules        
-    for rule in new_rules:
-        with settings(warn_only=True):
+            commands.add('ufw delete %s'% rule, warn_only=True)
+        for rule in new_rules:
             if env.verbosity:
                 print 'ufw', rule
-            sudo('ufw %s'% rule)
+            commands.add('ufw %s'% rule, warn_only=True)
+        commands.add('ufw reload')
     set_server_state('ufw_rules',list(firewall_rules))
 
-        
-    output = sudo('ufw reload')
+    output = commands.results[-1]
     if env.verbosity:
         print output
 
@@ -439,11 +503,14 @@ def setup_ufw_rules():
 def skip_disable_root():
     return env.root_disabled
 
-def uninstall_package(package):
+def uninstall_package(*packages):
     """
-    apt-get autoremove --purge
+    apt-get autoremove --purge [package ...] in one transaction
     """
-    sudo('apt-get autoremove --purge -qqy %s'% package, pty=True)
+    result = sudo('apt-get autoremove --purge -qqy %s'% ' '.join(packages), pty=True)
+    invalidate()
+    invalidate_fact('packages')
+    return result
 
 def uninstall_packages():
     """
@@ -458,10 +525,15 @@ def uninstall_packages():
     uninstall = installed - packages
     if uninstall and env.verbosity:
         print env.host,'UNINSTALLING HOST PACKAGES'
-    for p in uninstall:
+    if uninstall:
+        with settings(warn_only=True):
+            uninstall_package(*sorted(uninstall))
+        remaining = package_status()
+    for p in sorted(uninstall):
+        #any still installed are removed individually
+        if remaining.get(p,'').endswith(' installed'): uninstall_package(p)
         if env.verbosity:
-            print ' - uninstalling',p
-        uninstall_package(p)
+            print ' - uninstalled',p
         env.uninstalled_packages[env.host].append(p)
     set_server_state('packages_installed',get_packages())
     return
@@ -480,6 +552,7 @@ def upgrade_packages():
         print "If apt-get upgrade does not complete within 15 minutes"
         print "see troubleshooting docs *before* aborting the process to avoid package management corruption."
     sudo('apt-get -qqy upgrade')
+    invalidate()
 
 def upload_etc():
     """
@@ -515,7 +588,7 @@ def upload_etc():
     else: user_templates = set([])
     etc_templates = user_templates | default_templates
 
-    context = {'host_ip':socket.gethostbyname(env.host)}
+    context = {'host_ip':socket.gethostbyname(env.host), 'blue_green':env.BLUE_GREEN}
     if env.overwrite or env.installed_packages[env.host]: mod_only = False
     else: mod_only = True
     for t in etc_templates:
@@ -551,6 +624,7 @@ def upload_ssh_key(rollback=False):
         if not env.overwrite and server_state(u): return
         if not exists('.ssh'):
             run('mkdir .ssh')
+            invalidate('/home/%s/.ssh'% env.user)
            
         #determine local .ssh dir
         home = os.path.expanduser('~')
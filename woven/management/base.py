@@ -1,6 +1,7 @@
 #!/usr/bin/env python
-import sys
-
+import os, sys
+from multiprocessing import Process, Queue
+from Queue import Empty
 from optparse import make_option
 
 from django.conf import settings
@@ -9,9 +10,13 @@ from django.core.management.color import no_style
 
 from fabric import state 
 from fabric.network import normalize
-from fabric.context_managers import hide,show
+from fabric.context_managers import hide, show
+from fabric.context_managers import settings as fab_settings
 
-from woven.environment import set_env
+from woven.environment import set_env, flush_states, rolling_batches
+from woven.facts import clear_facts
+from woven.network import close_connections
+from woven.webservers import health_check
 
 class WovenCommand(BaseCommand):
     option_list = BaseCommand.option_list + (
@@ -49,6 +54,30 @@ class WovenCommand(BaseCommand):
             help='The /path/to/dir containing the setup.py module. The command will execute from this directory. Only required if you are not executing the command from below the setup.py directory',
         ),
         
+        make_option('--parallel',
+            type='int',
+            default=0,
+            help="run on up to N hosts at a time in separate worker processes after the first host has run on its own"
+        ),
+        
+    )
+    #options for commands that implement activate_host
+    rolling_option_list = (
+        make_option('--rolling',
+            action='store_true',
+            default=False,
+            help="activate the hosts of each role in batches, waiting for each batch to pass a health check"
+        ),
+        make_option('--batch-size',
+            dest='batch_size',
+            default='',
+            help="number or percentage (eg 25%) of a role's hosts to activate at a time. Defaults to ROLLING_BATCH_SIZE"
+        ),
+        make_option('--max-unavailable',
+            dest='max_unavailable',
+            default='',
+            help="number or percentage of a role's hosts that can be out of service at once. Defaults to ROLLING_MAX_UNAVAILABLE"
+        ),
     )
     help = ""
     args = "host1 [host2 ...] or user@host1 ..."
@@ -59,6 +88,15 @@ class WovenCommand(BaseCommand):
         """
         This will be executed per host - override in subclass
         """
+    
+    def prepare_host(self, *args, **options):
+        """
+        Executed on every host before a rolling activation - override in subclass
+        """
+    
+    #Override in subclass with the per host activation to support --rolling
+    activate_host = None
+    
     def parse_host_args(self, *args):
         """
         Returns a comma separated string of hosts
@@ -125,23 +163,248 @@ class WovenCommand(BaseCommand):
         #Back to the standard execution strategy
         # Set host list (also copy to env)
         state.env.all_hosts = hosts = state.env.hosts
-        # If hosts found, execute the function on each host in turn
+        try:
+            if options.get('rolling'):
+                if not self.activate_host:
+                    print "Error: This command does not support --rolling"
+                    sys.exit(1)
+                results = self.handle_rolling(hosts, *args, **options)
+                self.summary(results)
+            elif state.env.parallel > 1 and len(hosts) > 1:
+                results = self.handle_parallel(hosts, self.handle_host, *args, **options)
+                self.summary(results)
+            else:
+                # If hosts found, execute the function on each host in turn
+                for host in hosts:
+                    self.execute_host(host, self.handle_host, *args, **options)
+        finally:
+            #connections are pooled for the whole command
+            close_connections()
+
+    def execute_host(self, host, handler, *args, **options):
+        """
+        Set the fabric env for the ``host`` and execute ``handler``
+        """
+        # Preserve user
+        prev_user = state.env.user
+        # Split host string and apply to env dict
+        #TODO - This section is replaced by network.interpret_host_string in Fabric 1.0
+        username, hostname, port = normalize(host)
+        state.env.host_string = host
+        state.env.host = hostname
+        state.env.user = username
+        state.env.port = port
+
+        # Actually run command
+        if int(state.env.verbosity) < 2:
+            with hide('warnings', 'running', 'stdout', 'stderr'):
+                self.handle_with_states(handler, *args, **options)
+        else:
+            self.handle_with_states(handler, *args, **options)
+        # Put old user back
+        state.env.user = prev_user
+
+    def handle_with_states(self, handler, *args, **options):
+        """
+        Execute ``handler``, write back any server states it set and
+        forget the host facts
+        """
+        try:
+            handler(*args, **options)
+        finally:
+            flush_states()
+            clear_facts()
+
+    def handle_serial(self, hosts, handler, *args, **options):
+        """
+        Execute ``handler`` on each host in turn, stopping at the first failure
+        
+        Returns a list of (host, succeeded, message) tuples
+        """
+        results = []
         for host in hosts:
-            # Preserve user
-            prev_user = state.env.user
-            # Split host string and apply to env dict
-            #TODO - This section is replaced by network.interpret_host_string in Fabric 1.0
-            username, hostname, port = normalize(host)
-            state.env.host_string = host
-            state.env.host = hostname
-            state.env.user = username
-            state.env.port = port
-
-            # Actually run command
-            if int(state.env.verbosity) < 2:
-                with hide('warnings', 'running', 'stdout', 'stderr'):
-                    self.handle_host(*args, **options)
+            try:
+                self.execute_host(host, handler, *args, **options)
+            except SystemExit, e:
+                if not e.code: raise
+                results.append((host, False, 'exited with status %s'% e.code))
+                break
+            results.append((host, True, ''))
+        return results
+
+    def handle_parallel(self, hosts, handler, *args, **options):
+        """
+        Execute ``handler`` on up to ``env.parallel`` hosts at a time.
+        
+        The first host always runs in this process so that anything decorated
+        with runs_once (syncdb, migrations, the sqlite database) completes
+        exactly once before the workers are forked.
+        
+        Returns a list of (host, succeeded, message) tuples in host order
+        """
+        first = hosts[0]
+        results = dict([(first,r) for r in self.handle_serial([first], handler, *args, **options)])
+        if not results[first][1]:
+            print first, "FAILED. The remaining hosts will not be run."
+            return [results[first]]
+        
+        pending = list(hosts[1:])
+        running = {}
+        queue = Queue()
+        
+        def drain():
+            #collect the results of workers that reported and exited since the timeout
+            while True:
+                try:
+                    host, succeeded, message = queue.get_nowait()
+                except Empty:
+                    return
+                results[host] = (host, succeeded, message)
+                worker = running.pop(host, None)
+                if worker: worker.join()
+        
+        try:
+            while pending or running:
+                while pending and len(running) < max(state.env.parallel, 1):
+                    host = pending.pop(0)
+                    worker = Process(target=self._host_worker, args=(host, handler, queue, args, options))
+                    worker.start()
+                    running[host] = worker
+                try:
+                    host, succeeded, message = queue.get(timeout=1)
+                except Empty:
+                    drain()
+                    dead = [host for host, worker in running.items() if not worker.is_alive()]
+                    if dead:
+                        #a dead worker may have reported after the first drain
+                        drain()
+                    #a worker that died without reporting would otherwise block forever
+                    for host in dead:
+                        if host in running and host not in results:
+                            results[host] = (host, False, 'worker exited with status %s'% running[host].exitcode)
+                            del running[host]
+                    continue
+                results[host] = (host, succeeded, message)
+                worker = running.pop(host, None)
+                if worker: worker.join()
+        except KeyboardInterrupt:
+            for worker in running.values():
+                worker.terminate()
+            print >> sys.stderr, "\nStopped."
+            sys.exit(1)
+        return [results[host] for host in hosts if host in results]
+
+    def handle_rolling(self, hosts, *args, **options):
+        """
+        Run prepare_host on every host, then activate the hosts of each role
+        in batches. Each batch must pass the health check before the next
+        batch starts, and the roll-out stops at the first failed batch.
+        
+        Returns a list of (host, succeeded, message) tuples
+        """
+        if state.env.parallel > 1:
+            prepared = self.handle_parallel(hosts, self.prepare_host, *args, **options)
+        else:
+            prepared = self.handle_serial(hosts, self.prepare_host, *args, **options)
+        failed = [r for r in prepared if not r[1]]
+        if failed or len(prepared) < len(hosts):
+            print "ROLLING: deployment failed on %s. No hosts have been activated."% ', '.join([r[0] for r in failed])
+            return failed
+        
+        batch_size = options.get('batch_size') or state.env.ROLLING_BATCH_SIZE
+        max_unavailable = options.get('max_unavailable') or state.env.ROLLING_MAX_UNAVAILABLE
+        results = []
+        for role, batch in rolling_batches(hosts, batch_size, max_unavailable):
+            if state.env.verbosity:
+                print "ROLLING: activating %s"% ', '.join(batch), role and "(%s)"% role or ''
+            if len(batch) > 1:
+                with fab_settings(parallel=len(batch)):
+                    activated = self.handle_parallel(batch, self._activate_host_checked, *args, **options)
             else:
-                self.handle_host(*args, **options)
-            # Put old user back
-            state.env.user = prev_user
+                activated = self.handle_serial(batch, self._activate_host_checked, *args, **options)
+            results += activated
+            if [r for r in activated if not r[1]] or len(activated) < len(batch):
+                print "ROLLING: health check failed. Aborting the roll-out."
+                break
+        return results
+
+    def _activate_host_checked(self, *args, **options):
+        self.activate_host(*args, **options)
+        if not health_check():
+            print state.env.host, "ERROR: Failed the health check after activation"
+            sys.exit(1)
+
+    def _host_worker(self, host, handler, queue, args, options):
+        """
+        Runs in a forked worker process for a single host
+        """
+        #prompts cannot be answered from a worker
+        sys.stdin = open(os.devnull)
+        state.env.INTERACTIVE = False
+        output = _HostOutput(host, sys.stdout)
+        sys.stdout = sys.stderr = output
+        #the parent's ssh transports must not be shared across processes
+        state.connections.clear()
+        succeeded = False
+        message = ''
+        try:
+            try:
+                self.execute_host(host, handler, *args, **options)
+                succeeded = True
+            except SystemExit, e:
+                succeeded = not e.code
+                if not succeeded: message = 'exited with status %s'% e.code
+            except Exception, e:
+                message = ': '.join([e.__class__.__name__,str(e)])
+        finally:
+            output.flush()
+            if not succeeded and output.tail:
+                message = ' '.join([message,'-',output.tail[-1]])
+            close_connections(control_masters=False)
+            queue.put((host, succeeded, message))
+
+    def summary(self, results):
+        """
+        Print the outcome per host and exit non-zero if any host failed
+        """
+        failed = [r for r in results if not r[1]]
+        skipped = len(state.env.all_hosts) - len(results)
+        if state.env.verbosity or failed:
+            print "\nSUMMARY: %s of %s hosts succeeded"% (len(results)-len(failed), len(state.env.all_hosts))
+            for host, succeeded, message in results:
+                if succeeded: print ' *', host, 'OK'
+                else: print ' *', host, 'FAILED', message
+            if skipped: print ' * %s hosts skipped'% skipped
+        if failed or skipped: sys.exit(1)
+
+class _HostOutput(object):
+    """
+    A file like object that prefixes each line a parallel worker writes
+    with the host, and keeps the last few lines for the summary
+    """
+    def __init__(self, host, stream, tail=10):
+        self.host = host
+        self.fileno = stream.fileno
+        self.buffer = ''
+        self.tail = []
+        self.tail_length = tail
+
+    def write(self, text):
+        self.buffer += text
+        while '\n' in self.buffer:
+            line, self.buffer = self.buffer.split('\n',1)
+            self._write_line(line)
+
+    def _write_line(self, line):
+        #one write per line so output from several workers doesn't interleave
+        os.write(self.fileno(), '[%s] %s\n'% (self.host, line))
+        if line.strip():
+            self.tail = (self.tail + [line.strip()])[-self.tail_length:]
+
+    def flush(self):
+        if self.buffer:
+            self._write_line(self.buffer)
+            self.buffer = ''
+
+    def isatty(self):
+        return False
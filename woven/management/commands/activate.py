@@ -14,6 +14,7 @@ class Command(WovenCommand):
     e.g. python manage.py activate 0.1
     """
 
+    option_list = WovenCommand.option_list + WovenCommand.rolling_option_list
     help = "Activate a version of your project"
     requires_model_validation = False
     args = "version user@ipaddress [host2...]"
@@ -25,6 +26,9 @@ class Command(WovenCommand):
         return ','.join(args[1:])
     
     def handle_host(self,*args, **options):
+        self.activate_host(*args, **options)
+
+    def activate_host(self,*args, **options):
         vers = args[0]
         env.nomigration = True
         with project_version(vers):        
@@ -49,14 +49,19 @@ class Command(WovenCommand):
             help="Overwrite an existing installation"
         ),
         
-    )
+    ) + WovenCommand.rolling_option_list
     help = "Deploy the current version of your project"
     requires_model_validation = False
     
     def handle_host(self,*args, **options):
+        self.prepare_host(*args, **options)
+        self.activate_host(*args, **options)
+
+    def prepare_host(self,*args, **options):
         self.validate()
         deploy(overwrite=options.get('overwrite'))
-        
+    
+    def activate_host(self,*args, **options):
         with settings(nomigration = options.get('nomigration'),
                       migration = options.get('migration'),
                       manualmigration = options.get('manualmigration')):
@@ -6,8 +6,8 @@ from fabric import state
 from fabric.decorators import runs_once
 from fabric.context_managers import settings
 from fabric.operations import sudo
-from fabric.contrib.files import exists
 
+from woven.facts import exists, invalidate
 from woven.management.base import WovenCommand
 from woven.webservers import _get_django_sites, deploy_wsgi, deploy_webconf, domain_sites, reload_webservers
 from woven.project import deploy_sitesettings
@@ -40,6 +40,7 @@ class Command(WovenCommand):
                 if not exists('/'.join([path,'sites-enabled',site])):
                     sudo("chmod 644 %s" % '/'.join([path,'sites-available',site]))
                     sudo("ln -s %s/sites-available/%s %s/sites-enabled/%s"% (path,site,path,site))
+                    invalidate('%s/sites-enabled/%s'% (path,site))
                     if state.env.verbosity:
                         print " * enabled", "%s/sites-enabled/%s"% (path,site)
         reload_webservers()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+from optparse import make_option
+from glob import glob
+from multiprocessing import Pool, cpu_count
+import json, os, shutil, subprocess, tempfile
+
+from django.core.management.base import BaseCommand
+from django.core.management.color import no_style
+
+from fabric import state
+from fabric.context_managers import hide
+
+from woven.environment import set_env
+from woven.virtualenv import _requirement_lines, _requirement_name, wheelhouse_dir, wheelhouse_index
+
+def _build_wheel(args):
+    """
+    Build the wheels for one requirement line into a temporary directory.
+
+    Returns the line, the temporary directory and the pip return code
+    """
+    line, options, find_links, verbosity = args
+    build_dir = tempfile.mkdtemp(prefix='woven-wheel-')
+    requirement = line.startswith('-e ') and line[3:].strip() or line
+    command = ['pip','wheel','-q','--wheel-dir=%s'% build_dir,'--find-links=%s'% find_links] + options + [requirement]
+    if verbosity: print ' '.join(command)
+    devnull = open(os.devnull, 'w')
+    stdout = int(verbosity) < 2 and devnull or None
+    returncode = subprocess.call(command, stdout=stdout, stderr=subprocess.STDOUT)
+    devnull.close()
+    return line, build_dir, returncode
+
+class Command(BaseCommand):
+    """
+    Build wheels for your requirements into a local wheelhouse that deploy
+    syncs to hosts of the same platform
+
+    python manage.py wheelhouse
+    """
+    option_list = BaseCommand.option_list + (
+        make_option('-j', '--jobs',
+            type='int',
+            default=cpu_count(),
+            help="Number of requirements to build at a time"
+        ),
+        make_option('--rebuild',
+            action='store_true',
+            default=False,
+            help="Rebuild requirements that are already in the wheelhouse"
+        ),
+    )
+    help = "Build wheels for your requirements for deployment without a package index"
+    args = ""
+    requires_model_validation = False
+
+    def handle(self, *args, **options):
+
+        self.style = no_style()
+        #manage.py execution specific variables
+        #verbosity 0 = No output at all, 1 = woven output only, 2 = Fabric outputlevel = everything except debug
+        state.env.verbosity = int(options.get('verbosity', 1))
+
+        set_env.no_domain = True
+        state.env.INTERACTIVE = options.get('interactive')
+        if int(state.env.verbosity) < 2:
+            with hide('warnings', 'running', 'stdout', 'stderr'):
+                set_env()
+        else:
+            set_env()
+        if not state.env.PIP_REQUIREMENTS: req_files = glob('req*')
+        else: req_files = state.env.PIP_REQUIREMENTS
+        req_files = [r for r in req_files if not r.endswith('.zip')]
+        lines = _requirement_lines(sorted(req_files))
+        #index and find-links options apply to every build
+        pip_options = [l for l in lines if l.startswith('-') and not _requirement_name(l)]
+        pip_options = sum([l.split(None,1) for l in pip_options],[])
+
+        wheel_dir = wheelhouse_dir()
+        if not os.path.exists(wheel_dir):
+            os.makedirs(wheel_dir)
+        index = wheelhouse_index(wheel_dir)
+        build = []
+        for line in lines:
+            if not _requirement_name(line): continue
+            built = line in index and [w for w in index[line] if os.path.exists(os.path.join(wheel_dir,w))]
+            if options.get('rebuild') or not built or len(built) <> len(index[line]):
+                build.append((line, pip_options, wheel_dir, state.env.verbosity))
+            elif state.env.verbosity:
+                print 'Using the wheelhouse for', line
+
+        failed = []
+        if build:
+            pool = Pool(max(1, min(options.get('jobs') or 1, len(build))))
+            try:
+                results = pool.map(_build_wheel, build)
+            finally:
+                pool.close()
+                pool.join()
+            for line, build_dir, returncode in results:
+                if returncode:
+                    failed.append(line)
+                else:
+                    wheels = sorted([w for w in os.listdir(build_dir) if w.endswith('.whl')])
+                    for wheel in wheels:
+                        shutil.move(os.path.join(build_dir,wheel),os.path.join(wheel_dir,wheel))
+                    index[line] = wheels
+                shutil.rmtree(build_dir, ignore_errors=True)
+            json.dump(index, open(os.path.join(wheel_dir,'index.json'),'w'), indent=1, sort_keys=True)
+
+        if state.env.verbosity:
+            print 'Wheelhouse', wheel_dir
+        if failed:
+            for line in failed:
+                print 'ERROR: Could not build a wheel for', line
+            raise SystemExit(1)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+Connection pooling for the lifetime of a woven command.
+
+Paramiko already multiplexes every run, sudo, get and put as a new channel
+over one transport, and fabric already caches a connection per host string.
+The pool checks a cached connection is still alive before it is used and
+keeps idle connections open with ssh keepalives. rsync goes through the local
+ssh client instead, so it shares an OpenSSH ControlMaster connection per
+(user, host, port).
+"""
+import os, shutil, subprocess, tempfile
+
+from fabric import state
+from fabric.network import HostConnectionCache, connect, normalize, join_host_strings
+
+class ConnectionPool(HostConnectionCache):
+    """
+    A replacement for fabric's connection cache that checks a cached
+    connection is still alive before handing it out, reconnects if it
+    isn't, and keeps connections open across idle periods with ssh keepalives.
+    """
+    def __getitem__(self, key):
+        user, host, port = normalize(key)
+        real_key = join_host_strings(user, host, port)
+        client = dict.get(self, real_key)
+        if client is not None:
+            transport = client.get_transport()
+            if not transport or not transport.is_active():
+                client.close()
+                dict.__delitem__(self, real_key)
+                client = None
+        if client is None:
+            client = connect(user, host, port)
+            keepalive = state.env.get('SSH_KEEPALIVE')
+            if keepalive: client.get_transport().set_keepalive(int(keepalive))
+            dict.__setitem__(self, real_key, client)
+        return client
+
+def connection_pool():
+    """
+    Turn fabric's connection cache into a ConnectionPool, keeping any
+    connections that are already open.
+
+    Returns the pool
+    """
+    if not isinstance(state.connections, ConnectionPool):
+        #fabric.operations, fabric.sftp etc hold their own reference from import
+        #time so the cache is changed in place rather than replaced
+        state.connections.__class__ = ConnectionPool
+    return state.connections
+
+def _control_dir():
+    """
+    A private directory for the ssh ControlMaster sockets of this command
+    """
+    if not state.env.get('ssh_control_dir'):
+        state.env.ssh_control_dir = tempfile.mkdtemp(prefix='woven-ssh-')
+    return state.env.ssh_control_dir
+
+def _multiplex_supported():
+    """
+    ControlPersist requires OpenSSH 5.6 or later
+    """
+    if not hasattr(state.env, 'ssh_multiplex_supported'):
+        devnull = open(os.devnull, 'w')
+        try:
+            returncode = subprocess.call(['ssh','-o','ControlPersist=60','-V'], stdout=devnull, stderr=devnull)
+        except OSError:
+            returncode = 1
+        devnull.close()
+        state.env.ssh_multiplex_supported = returncode == 0
+    return state.env.ssh_multiplex_supported
+
+def ssh_command():
+    """
+    The local ssh command for the current host, as used by rsync.
+
+    Every call for the same (user, host, port) shares one master connection
+    when SSH_MULTIPLEX is enabled and the local ssh supports it.
+    """
+    options = ['ssh','-p %s'% state.env.port]
+    keys = state.env.key_filename
+    if keys:
+        if not isinstance(keys, (list, tuple)): keys = [keys]
+        options += ['-i %s'% key for key in keys]
+    if state.env.get('SSH_MULTIPLEX') and _multiplex_supported():
+        control_path = os.path.join(_control_dir(),'%r@%h:%p')
+        #the master is stopped by close_connections at the end of the command
+        options += ['-o ControlMaster=auto',
+                    '-o ControlPath=%s'% control_path,
+                    '-o ControlPersist=300']
+    return ' '.join(options)
+
+def close_connections(control_masters=True):
+    """
+    Close all pooled connections and stop any ssh master connections.
+    
+    Worker processes share the master connections of the parent process
+    so they should only close their own with ``control_masters=False``
+    """
+    for client in state.connections.values():
+        client.close()
+    state.connections.clear()
+    control_dir = state.env.get('ssh_control_dir')
+    if control_masters and control_dir and os.path.exists(control_dir):
+        devnull = open(os.devnull, 'w')
+        for socket_name in os.listdir(control_dir):
+            subprocess.call(['ssh','-o','ControlPath=%s'% os.path.join(control_dir, socket_name),'-O','exit','woven'],
+                            stdout=devnull, stderr=devnull)
+        devnull.close()
+        shutil.rmtree(control_dir, ignore_errors=True)
+        state.env.ssh_control_dir = ''
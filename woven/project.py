@@ -2,21 +2,32 @@
 """
 Anything related to deploying your project modules, media, and data
 """
-import os, shutil, sys
+from hashlib import sha1
+import gzip, json, os, shutil, sys
 
 from django.template.loader import render_to_string
 
 from fabric.state import env
 from fabric.operations import local, run, put, sudo
 from fabric.decorators import runs_once
-from fabric.contrib.files import exists
 from fabric.contrib.console import confirm
 #Required for a bug in 0.9
 from fabric.version import get_version
 
 from woven.decorators import run_once_per_version
-from woven.deployment import deploy_files
+from woven.deployment import deploy_files, _local_index, _walk_local_files
 from woven.environment import deployment_root, _root_domain
+from woven.facts import command_fact, exists
+from woven.virtualenv import active_version
+
+def _link_dest(remote_dir):
+    """
+    The same directory as ``remote_dir`` in the active version, if it isn't this version
+    """
+    active = active_version()
+    if not active or active == env.project_fullname: return ''
+    version_root = '/'.join([deployment_root(),'env',env.project_fullname])
+    return remote_dir.replace(version_root,'/'.join([deployment_root(),'env',active]),1)
 
 @runs_once
 def _make_local_sitesettings(overwrite=False):
@@ -73,14 +84,14 @@ def deploy_project():
 
     #make site local settings if they don't already exist
     _make_local_sitesettings()
-    created = deploy_files(local_dir, project_root, rsync_exclude=rsync_exclude)
+    created = deploy_files(local_dir, project_root, rsync_exclude=rsync_exclude, link_dest=_link_dest(project_root))
     if not env.patch:
         #hook the project into sys.path
-        pyvers = run('python -V').split(' ')[1].split('.')[0:2] #Python x.x.x
+        pyvers = command_fact('python_version').split(' ')[1].split('.')[0:2] #Python x.x.x
         sitepackages = ''.join(['lib/python',pyvers[0],'.',pyvers[1],'/site-packages'])
         link_name = '/'.join([deployment_root(),'env',env.project_fullname,sitepackages,env.project_package_name])
         target = '/'.join([project_root,env.project_package_name])
-        run(' '.join(['ln -s',target,link_name]))
+        run(' '.join(['ln -sfn',target,link_name]))
         
         #make sure manage.py has exec permissions
         managepy = '/'.join([target,'sitesettings','manage.py'])
@@ -126,9 +137,118 @@ def deploy_templates():
         remote_dir = '/'.join([deployment_root(),'env',env.project_fullname,'templates'])
         if env.verbosity:
             print env.host,"DEPLOYING templates", remote_dir
-        deployed = deploy_files(env.project_template_dir,remote_dir)
+        deployed = deploy_files(env.project_template_dir,remote_dir,link_dest=_link_dest(remote_dir))
     return deployed
      
+#Static files that are worth compressing
+COMPRESSIBLE_EXTENSIONS = ['.css','.js','.html','.htm','.txt','.xml','.json','.svg','.map','.ico','.eot','.ttf']
+
+def _fingerprinted(path, hashed):
+    """
+    path/name.ext as path/name.[hash].ext
+    """
+    root, ext = os.path.splitext(path)
+    return ''.join([root,'.',hashed[:12],ext])
+
+def _compressed(source, hashed, cache_dir, ext):
+    """
+    A cached .gz or .br copy of ``source`` by content hash, or '' if it doesn't get smaller
+    """
+    cached = os.path.join(cache_dir, hashed + ext)
+    if not os.path.exists(cached):
+        data = open(source,'rb').read()
+        if ext == '.gz':
+            #no filename or timestamp so the output only depends on the content
+            out = open(cached + '.tmp','wb')
+            f = gzip.GzipFile('', 'wb', 9, out, 0)
+            f.write(data)
+            f.close()
+            out.close()
+        else:
+            import brotli
+            open(cached + '.tmp','wb').write(brotli.compress(data))
+        if os.path.getsize(cached + '.tmp') >= len(data):
+            #remember that it isn't worth it
+            open(cached + '.tmp','wb').close()
+        os.rename(cached + '.tmp', cached)
+    return os.path.getsize(cached) and cached or ''
+
+def _prune_compressed(cache_dir, hashes):
+    """
+    Remove the cached compressed files whose content hash isn't in ``hashes``
+    and that aren't linked into any other build
+    """
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if os.path.splitext(name)[0] in hashes or not os.path.isfile(path): continue
+        if os.stat(path).st_nlink == 1: os.remove(path)
+
+def _link(source, dest):
+    """
+    Hard link or copy ``source`` to ``dest`` if it isn't already
+    """
+    if os.path.exists(dest):
+        if os.path.samefile(source, dest): return
+        os.remove(dest)
+    dest_dir = os.path.dirname(dest)
+    if not os.path.exists(dest_dir): os.makedirs(dest_dir)
+    try:
+        os.link(source, dest)
+    except OSError:
+        shutil.copy2(source, dest)
+
+def static_pipeline(local_dir):
+    """
+    Build a copy of ``local_dir`` in ~/.woven/static with a fingerprinted copy
+    of each file, a staticfiles.json manifest of the fingerprinted names, and
+    .gz (and .br if the brotli module is installed) copies of text files.
+    
+    Compressed files are cached by content hash so unchanged files are never
+    processed twice, and compressed copies already in ``local_dir`` are kept.
+    Returns the directory to deploy
+    """
+    woven_dir = os.path.join(os.path.expanduser('~'),'.woven')
+    build_dir = os.path.join(woven_dir,'static',sha1(os.path.abspath(local_dir)).hexdigest())
+    cache_dir = os.path.join(woven_dir,'static-cache')
+    if not os.path.exists(cache_dir): os.makedirs(cache_dir)
+    extensions = ['.gz']
+    if env.STATIC_PIPELINE_BROTLI:
+        try:
+            import brotli
+            extensions.append('.br')
+        except ImportError:
+            print "WARNING: Install the brotli python module to precompress static files with brotli"
+    
+    paths = list(_walk_local_files(local_dir))
+    index = _local_index(local_dir, paths)
+    manifest = {}
+    built = set(['staticfiles.json'])
+    for path in paths:
+        source = os.path.join(local_dir,path)
+        hashed = index[path][2]
+        manifest[path.replace(os.sep,'/')] = _fingerprinted(path,hashed).replace(os.sep,'/')
+        for name in [path, _fingerprinted(path,hashed)]:
+            _link(source, os.path.join(build_dir,name))
+            built.add(name)
+            if os.path.splitext(path)[1].lower() not in COMPRESSIBLE_EXTENSIONS: continue
+            for ext in extensions:
+                #keep any compressed copy that is already in local_dir
+                if path + ext in index: continue
+                compressed = _compressed(source, hashed, cache_dir, ext)
+                if compressed:
+                    _link(compressed, os.path.join(build_dir,name + ext))
+                    built.add(name + ext)
+    f = open(os.path.join(build_dir,'staticfiles.json'),'w')
+    json.dump({'paths':manifest,'version':'1.0'}, f, indent=1, sort_keys=True)
+    f.close()
+    #remove anything left from previous builds
+    for path in _walk_local_files(build_dir):
+        if path not in built: os.remove(os.path.join(build_dir,path))
+    for root, dirs, files in os.walk(build_dir, topdown=False):
+        if root <> build_dir and not os.listdir(root): os.rmdir(root)
+    _prune_compressed(cache_dir, set([entry[2] for entry in index.values()]))
+    return build_dir
+
 @run_once_per_version
 def deploy_static():
     """
@@ -158,9 +278,11 @@ def deploy_static():
             if static_url:
                 remote_dir = '/'.join([remote_dir,static_url])
         else: return
+    if env.STATIC_PIPELINE:
+        local_dir = static_pipeline(local_dir)
     if env.verbosity:
         print env.host,"DEPLOYING static",remote_dir
-    return deploy_files(local_dir,remote_dir)
+    return deploy_files(local_dir,remote_dir,link_dest=_link_dest(remote_dir))
 
 @run_once_per_version       
 def deploy_media():
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 from glob import glob
-import os, sys
+from hashlib import sha1
+import json, os, platform, re, sys
 import site
 
 from django import get_version
@@ -11,14 +12,16 @@ from fabric.decorators import runs_once
 from fabric.state import env 
 from fabric.operations import run, sudo
 from fabric.context_managers import cd, settings
-from fabric.contrib.files import exists
 from fabric.contrib.console import confirm
 
 from woven.decorators import run_once_per_version
-from woven.deployment import mkdirs, deploy_files
-from woven.environment import deployment_root,set_version_state, version_state, get_packages
-from woven.environment import post_exec_hook, State
-from woven.webservers import _get_django_sites, _ls_sites, _sitesettings_files, stop_webserver, start_webserver, webserver_list, domain_sites
+from woven.deployment import batch, mkdirs, deploy_files
+from woven.environment import deployment_root,set_version_state, version_state, delete_version_states, get_packages
+from woven.environment import server_state, set_server_state
+from woven.environment import post_exec_hook, remote_python, State
+from woven.facts import command_fact, exists, invalidate, readlink
+from woven.webservers import _get_django_sites, _ls_sites, _sitesettings_files, stop_webserver, start_webserver, reload_webserver, webserver_list, domain_sites
+from woven.webservers import start_slot, drain_slot, version_slot, purge_proxy_cache, remove_stale_jobs
 from fabric.contrib.files import append
 
 def active_version():
@@ -30,7 +33,8 @@ def active_version():
     
     link = '/'.join([deployment_root(),'env',env.project_name])
     if not exists(link): return None
-    active = os.path.split(run('ls -al '+link).split(' -> ')[1])[1]
+    target = readlink(link) or run('ls -al '+link).split(' -> ')[1]
+    active = os.path.split(target)[1]
     return active
 
 def activate():
@@ -50,8 +54,13 @@ def activate():
 
     active = active_version()
     servers = webserver_list()
+    #with blue/green the new version is started on the other slot and traffic is cut over
+    blue_green = env.BLUE_GREEN and not env.patch and active <> env.project_fullname and \
+                 ('apache2' in servers or 'gunicorn' in servers)
+    #the old version keeps serving until the new one is reloaded
+    graceful = blue_green or env.GRACEFUL_RELOAD and not (env.manualmigration or env.MANUAL_MIGRATION)
 
-    if env.patch or active <> env.project_fullname:
+    if (env.patch or active <> env.project_fullname) and not graceful:
         for s in servers:
             stop_webserver(s)
         
@@ -76,28 +85,40 @@ def activate():
         else:
             site_paths = ['/etc/nginx']
         
-        #disable existing sites
-        for path in site_paths:
-            for site in _ls_sites('/'.join([path,'sites-enabled'])):
-                if site not in activate_sites:
-                    sudo("rm %s/sites-enabled/%s"% (path,site))
+        if blue_green:
+            old_slot = version_slot() == 'blue' and 'green' or 'blue'
+            old_sites = []
+            if 'apache2' in get_packages():
+                old_sites = [site for site in _ls_sites('/etc/apache2/sites-enabled') if site not in activate_sites]
+            slot = start_slot(activate_sites)
+            #apache serves both versions until the old one is drained
+            site_paths = ['/etc/nginx']
         
-        #activate new sites
-        for path in site_paths:
-            for site in activate_sites:
-                if not exists('/'.join([path,'sites-enabled',site])):
-                    sudo("chmod 644 %s" % '/'.join([path,'sites-available',site]))
-                    sudo("ln -s %s/sites-available/%s %s/sites-enabled/%s"% (path,site,path,site))
-                    if env.verbosity:
-                        print " * enabled", "%s/sites-enabled/%s"% (path,site)
+        with batch(use_sudo=True) as commands:
+            #disable existing sites
+            for path in site_paths:
+                for site in _ls_sites('/'.join([path,'sites-enabled'])):
+                    if site not in activate_sites:
+                        commands.add("rm %s/sites-enabled/%s"% (path,site))
+            
+            #activate new sites
+            for path in site_paths:
+                for site in activate_sites:
+                    if not exists('/'.join([path,'sites-enabled',site])):
+                        commands.add("chmod 644 %s" % '/'.join([path,'sites-available',site]))
+                        commands.add("ln -s %s/sites-available/%s %s/sites-enabled/%s"% (path,site,path,site))
+                        if env.verbosity:
+                            print " * enabled", "%s/sites-enabled/%s"% (path,site)
+        invalidate(*['/'.join([path,'sites-enabled']) for path in site_paths])
         
-        #delete existing symlink
-        ln_path = '/'.join([deployment_root(),'env',env.project_name])
-        run('rm -f '+ln_path)
         #run post deploy hooks
         post_exec_hook('post_deploy')
-        #activate
-        run('ln -s %s %s'% (env_path,ln_path))
+        #activate by renaming a new symlink over the existing one
+        ln_path = '/'.join([deployment_root(),'env',env.project_name])
+        run('ln -sfn %s %s.tmp && mv -Tf %s.tmp %s'% (env_path,ln_path,ln_path,ln_path))
+        invalidate(ln_path)
+        if blue_green:
+            set_server_state('blue_green-%s'% env.project_name,object={'version':env.project_fullname,'slot':slot})
 
   
         if env.verbosity:
@@ -106,9 +127,19 @@ def activate():
         if env.verbosity and not env.patch:
             print env.project_fullname,"is the active version"
 
-    if env.patch or active <> env.project_fullname:
+    if blue_green:
+        #cut the traffic over then stop the previous version
+        reload_webserver('nginx')
+        purge_proxy_cache()
+        drain_slot(old_slot, old_sites, active)
+        print
+    elif env.patch or active <> env.project_fullname:
         for s in servers:
-            start_webserver(s)
+            if graceful: reload_webserver(s)
+            else: start_webserver(s)
+        #pages cached from the previous version
+        if not env.patch: purge_proxy_cache()
+        if active and active <> env.project_fullname: remove_stale_jobs(active)
         print
     return
 
@@ -180,6 +211,332 @@ def migration():
                 print output
     return           
 
+def _requirements():
+    """
+    Determine the local requirement files, any matching bundles in dist,
+    and the django requirement. Creates a requirements.txt if there are none.
+    
+    Returns a req file:bundle dictionary and the django requirement
+    """
+    #determine what req files or bundle files we need to deploy
+    if not env.PIP_REQUIREMENTS:
+        req_files = {}.fromkeys(glob('req*'))
+    else:
+        req_files = {}.fromkeys(env.PIP_REQUIREMENTS)
+    
+    for key in req_files:
+        bundle = ''.join([key.split('.')[0],'.zip'])
+        if os.path.exists(os.path.join('dist',bundle)):
+            req_files[key] = bundle
+        
+    #determine the django version
+    django_version = get_version()
+    svn_version = django_version.find('SVN')
+    if svn_version > -1:
+        django_version = django_version[svn_version+4:]
+        django_req = ''.join(['-e svn+http://code.djangoproject.com/svn/django/trunk@',django_version,'#egg=Django'])
+    else:
+        other_builds = ['alpha','beta','rc']
+        for b in other_builds:
+            if b in django_version:
+                print "ERROR: Unsupported Django version", django_version
+                print "Define a DJANGO_REQUIREMENT pointing to the tar.gz for",django_version
+                print "and re-deploy, or use the official or SVN release of Django."
+                sys.exit(1)
+        django_req = ''.join(['Django==',django_version])
+
+    #if no requirements file exists create one
+    if not req_files:
+        f = open("requirements.txt","w+")
+        text = render_to_string('woven/requirements.txt', {'django':django_req})
+        f.write(text)
+        f.close()
+        if env.verbosity:
+            print "Created local requirements.txt"
+        req_files["requirements.txt"]=''
+        
+    return req_files, django_req
+
+def requirements_hash():
+    """
+    A hash of the requirement files, bundles and django version
+    that identifies an equivalent virtualenv on the host
+    """
+    req_files, django_req = _requirements()
+    hashed = sha1(django_req)
+    for req in sorted(req_files):
+        hashed.update(req)
+        hashed.update(open(req).read())
+        if req_files[req]:
+            hashed.update(open(os.path.join('dist',req_files[req]),'rb').read())
+    return hashed.hexdigest()
+
+def _clone_virtualenv(source, path):
+    """
+    Copy the virtualenv at ``source`` to ``path`` and relocate it
+    """
+    with batch() as commands:
+        commands.add('mkdir -p %s'% path)
+        for d in ['bin','include','lib','lib64','local','egg_cache','src']:
+            commands.add('if [ -e %s/%s ]; then cp -a %s/%s %s/; fi'% (source,d,source,d,path))
+        #virtualenv writes its absolute path into scripts and activate
+        commands.add("grep -rlI '%s' %s/bin %s/lib | xargs -r sed -i -e 's#%s/#%s/#g' -e 's#%s\"#%s\"#g'"%
+                     (source, path, path, source, path, source, path))
+        #and links in the environment (eg the project in site-packages) need to follow
+        commands.add("""find %s -type l -lname '%s/*' -exec sh -c 'ln -sfn "%s$(readlink "$1" | cut -c%d-)" "$1"' _ {} \\;"""%
+                     (path, source, path, len(source)+1))
+    invalidate(path)
+
+def _matching_virtualenv(req_hash):
+    """
+    An existing virtualenv on the host built from the same requirements
+    """
+    path = '/'.join([deployment_root(),'env',env.project_fullname])
+    envs = server_state('requirements-%s'% req_hash) or []
+    for env_path in reversed(envs):
+        if env_path == path or not exists(env_path): continue
+        #the environment may have been rebuilt since
+        with settings(project_fullname=os.path.basename(env_path)):
+            if version_state('requirements_hash') == req_hash: return env_path
+    return ''
+
+def _requirement_lines(req_files_list):
+    """
+    The requirements in the local requirement files, following any ``-r`` includes
+    """
+    lines = []
+    for req in req_files_list:
+        for line in open(req).readlines():
+            line = line.split(' #')[0].strip()
+            if not line or line.startswith('#'): continue
+            if line.startswith('-r') or line.startswith('--requirement'):
+                include = line.split('=',1)[-1].split()[-1]
+                lines += _requirement_lines([os.path.join(os.path.dirname(req),include)])
+            elif line not in lines:
+                lines.append(line)
+    return lines
+
+def _requirement_name(line):
+    """
+    The distribution name of a requirement line or '' for an option
+    """
+    if '#egg=' in line:
+        name = line.split('#egg=')[-1].split('&')[0]
+    elif line.startswith('-'):
+        return ''
+    else:
+        name = re.match(r'[A-Za-z0-9_.\-]*', line).group(0)
+    return name.lower().replace('_','-')
+
+def wheelhouse_platform(system='', machine='', python_version=''):
+    """
+    The platform a wheel is built for eg linux-x86_64-py2.6.
+    
+    Defaults to the local platform
+    """
+    system = system or platform.system().lower()
+    machine = machine or platform.machine()
+    python_version = python_version or platform.python_version()
+    return '-'.join([system, machine, 'py'+'.'.join(python_version.split('.')[:2])])
+
+def wheelhouse_dir(platform_name=''):
+    """
+    The local wheelhouse for a platform, shared by all projects
+    """
+    return os.path.join(os.path.expanduser('~'),'.woven','wheelhouse',platform_name or wheelhouse_platform())
+
+def wheelhouse_index(local_dir):
+    """
+    The requirement line:[wheel filenames] index of a local wheelhouse
+    """
+    try:
+        return json.load(open(os.path.join(local_dir,'index.json')))
+    except (IOError, ValueError):
+        return {}
+
+def _wheelhouse_wheels(requirements):
+    """
+    The local wheelhouse for the host platform and the wheels that install
+    ``requirements``, or None if any requirement hasn't been built for it
+    """
+    python_version = command_fact('python_version').split()[-1]
+    local_dir = wheelhouse_dir(wheelhouse_platform('linux', command_fact('machine'), python_version))
+    index = wheelhouse_index(local_dir)
+    wheels = set([])
+    for line in requirements:
+        if not _requirement_name(line): continue
+        if line not in index: return local_dir, None
+        for wheel in index[line]:
+            if not os.path.exists(os.path.join(local_dir,wheel)): return local_dir, None
+            wheels.add(wheel)
+    return local_dir, sorted(wheels)
+
+def _pip_args(lines, wheelhouse=False):
+    """
+    Quoted pip install arguments for requirement ``lines``.
+    
+    VCS requirements are installed by name from a wheelhouse
+    """
+    args = []
+    for line in lines:
+        if wheelhouse and '#egg=' in line: args.append(_requirement_name(line))
+        elif line.startswith('-e '): args.append("-e '%s'"% line[3:].strip())
+        elif line.startswith('-'): args.append(line)
+        else: args.append("'%s'"% line)
+    return ' '.join(args)
+
+#Removes the least recently used pip cache entries until the cache fits in max_size
+EVICT_SCRIPT = r"""
+import os, shutil, stat, sys
+max_size = int(sys.argv[1])*1024*1024
+entries = {}
+def usage(path):
+    paths = [path]
+    if os.path.isdir(path) and not os.path.islink(path):
+        for dirpath, dirnames, filenames in os.walk(path):
+            paths += [os.path.join(dirpath, n) for n in filenames]
+    size = used = 0
+    for p in paths:
+        try:
+            st = os.lstat(p)
+        except OSError:
+            continue
+        size += st.st_size
+        #listing a directory updates its access time
+        used = max(used, st.st_mtime, stat.S_ISREG(st.st_mode) and st.st_atime or 0)
+    return size, used
+for root in sys.argv[2:]:
+    if not os.path.isdir(root): continue
+    for name in os.listdir(root):
+        #pip keeps a .content-type file beside each download
+        key = os.path.join(root, name.replace('.content-type',''))
+        size, used = usage(os.path.join(root, name))
+        total, last = entries.get(key, (0, 0))
+        entries[key] = (total + size, max(last, used))
+total = sum([size for size, used in entries.values()])
+removed = []
+for key in sorted(entries, key=lambda k: entries[k][1]):
+    if total <= max_size: break
+    for path in [key, key + '.content-type']:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.lexists(path):
+            os.remove(path)
+    total -= entries[key][0]
+    removed.append(key)
+print '\n'.join(removed)
+"""
+
+def pip_cache_root():
+    """
+    The pip download cache and editable checkouts shared by all projects of the user
+    """
+    return env.PIP_CACHE_ROOT or '/'.join(['/home',env.user,'.pip'])
+
+def _src_name(line):
+    """
+    The directory pip checks out an editable requirement into
+    """
+    return line.split('#egg=')[-1].split('&')[0].lower()
+
+def _shared_src_name(line):
+    """
+    The shared checkout of an editable requirement. Keyed by its repository
+    so requirements with the same egg name from different repositories are kept apart
+    """
+    url = line[2:].strip().split('#')[0]
+    #the same repository at another revision shares the checkout
+    head, sep, rev = url.rpartition('@')
+    if sep and '/' not in rev: url = head
+    return '-'.join([_src_name(line), sha1(url).hexdigest()[:8]])
+
+def _src_checkouts(requirements):
+    """
+    (version src name, shared checkout name) of each editable requirement
+    """
+    return [(_src_name(line), _shared_src_name(line)) for line in requirements
+            if line.startswith('-e') and '#egg=' in line]
+
+def _seed_src(requirements, src, checkouts):
+    """
+    Copy the shared checkouts of editable requirements into the version ``src``
+    so pip only fetches what has changed since
+    """
+    names = _src_checkouts(requirements)
+    if not names: return
+    with batch() as commands:
+        commands.add('mkdir -p %s'% src)
+        for name, shared in names:
+            commands.add('if [ -d %s/%s ] && [ ! -e %s/%s ]; then cp -a %s/%s %s/%s; fi'%
+                         (checkouts, shared, src, name, checkouts, shared, src, name))
+    invalidate(src)
+
+def _share_src(requirements, src, checkouts):
+    """
+    Refresh the shared checkouts from the version ``src`` after an install
+    """
+    names = _src_checkouts(requirements)
+    if not names or not exists(src): return
+    with batch() as commands:
+        commands.add('mkdir -p %s'% checkouts)
+        for name, shared in names:
+            commands.add('if [ -d %s/%s ]; then rsync -a --delete %s/%s/ %s/%s/ && touch %s/%s; fi'%
+                         (src, name, src, name, checkouts, shared, checkouts, shared))
+    invalidate(checkouts)
+
+def evict_pip_cache():
+    """
+    Remove the least recently used downloads and checkouts from the pip cache
+    until it is under PIP_CACHE_MAX_SIZE megabytes
+    """
+    if not env.PIP_CACHE_MAX_SIZE: return []
+    root = pip_cache_root()
+    output = remote_python(EVICT_SCRIPT, str(int(env.PIP_CACHE_MAX_SIZE)),
+                           '/'.join([root,'cache']), '/'.join([root,'src']))
+    removed = output.succeeded and [path for path in output.split('\n') if path.strip()] or []
+    if removed:
+        invalidate(root)
+        if env.verbosity:
+            print env.host, 'Evicted', len(removed), 'entries from the pip cache'
+    return removed
+
+def _incremental_base():
+    """
+    The active version if its requirements were recorded and it can be cloned
+    """
+    active = active_version()
+    if not active or active == env.project_fullname: return ''
+    with settings(project_fullname=active):
+        #versions deployed before requirements were recorded need a full install
+        if not version_state('requirements'): return ''
+    return active
+
+def _pip_delta(previous, requirements, pip, options, wheelhouse=False):
+    """
+    Install or upgrade the added and changed requirements and uninstall
+    the removed distributions. Returns the failed command or None
+    """
+    old = dict([(_requirement_name(line), line) for line in previous])
+    new = dict([(_requirement_name(line), line) for line in requirements])
+    old.pop('',None)
+    new.pop('',None)
+    removed = sorted([name for name in old if name not in new])
+    changed = sorted([new[name] for name in new if old.get(name) <> new[name]])
+    if removed:
+        if env.verbosity:
+            print ' * uninstalling', ', '.join(removed)
+        result = run('%s uninstall -y %s'% (pip, ' '.join(removed)))
+        if result.failed: return result
+    if changed:
+        if env.verbosity:
+            print ' * installing', ', '.join(changed)
+        lines = [l for l in requirements if l.startswith('-') and not _requirement_name(l)] + changed
+        result = run('%s install -q --upgrade %s %s'% (pip, options, _pip_args(lines, wheelhouse)))
+        if result.failed: return result
+    if not removed and not changed and env.verbosity:
+        print ' * no requirements changed'
+    return None
+
 @run_once_per_version
 def mkvirtualenv():
     """
@@ -188,17 +545,37 @@ def mkvirtualenv():
     root = '/'.join([deployment_root(),'env'])
     path = '/'.join([root,env.project_fullname])
     dirs_created = []
-    if env.verbosity:
-        print env.host,'CREATING VIRTUALENV', path
     if not exists(root): dirs_created += mkdirs(root)
-    with cd(root):
-        run(' '.join(["virtualenv",env.project_fullname]))
-    with cd(path):
-        dirs_created += mkdirs('egg_cache')
-        sudo('chown -R %s:www-data egg_cache'% env.user)
-        sudo('chmod -R g+w egg_cache')
-        run(''.join(["echo 'cd ",path,'/','project','/',env.project_package_name,'/sitesettings',"' > bin/postactivate"]))
-        sudo('chmod ugo+rwx bin/postactivate')
+    #reuse an environment built from the same requirements
+    req_hash = requirements_hash()
+    source = not env.overwrite and _matching_virtualenv(req_hash)
+    #bundles are always installed in full so there is nothing to diff
+    base = ''
+    if not source and env.PIP_INCREMENTAL and not env.overwrite and not [b for b in _requirements()[0].values() if b]:
+        base = _incremental_base()
+    if source:
+        if env.verbosity:
+            print env.host,'CLONING VIRTUALENV', source, 'to', path
+        _clone_virtualenv(source, path)
+        set_version_state('requirements_hash',object=req_hash)
+    elif base:
+        #pip_install_requirements only installs the difference
+        if env.verbosity:
+            print env.host,'CLONING ACTIVE VIRTUALENV', base, 'to', path
+        _clone_virtualenv('/'.join([root,base]), path)
+        set_version_state('cloned_from',object=base)
+    else:
+        if env.verbosity:
+            print env.host,'CREATING VIRTUALENV', path
+        with cd(root):
+            run(' '.join(["virtualenv",env.project_fullname]))
+        invalidate(path)
+        with cd(path):
+            dirs_created += mkdirs('egg_cache')
+            sudo('chown -R %s:www-data egg_cache'% env.user)
+            sudo('chmod -R g+w egg_cache')
+            run(''.join(["echo 'cd ",path,'/','project','/',env.project_package_name,'/sitesettings',"' > bin/postactivate"]))
+            sudo('chmod ugo+rwx bin/postactivate')
 
     #Create a state
     out = State(' '.join([env.host,'virtualenv',path,'created']))
@@ -215,10 +592,18 @@ def rmvirtualenv():
     if version_state('mkvirtualenv'):
         sudo(' '.join(['rm -rf',path]))
         sudo(' '.join(['rm -f',link]))
-        sudo('rm -f /var/local/woven/%s*'% env.project_fullname)
-        set_version_state('mkvirtualenv',delete=True)
+        invalidate(path,link)
+        delete_version_states()
       
 
+def _record_requirements_env(req_hash):
+    """
+    Add this version's environment to those built from ``req_hash``
+    """
+    env_path = '/'.join([deployment_root(),'env',env.project_fullname])
+    envs = [e for e in server_state('requirements-%s'% req_hash) or [] if e <> env_path]
+    set_server_state('requirements-%s'% req_hash,object=envs+[env_path])
+
 @run_once_per_version    
 def pip_install_requirements():
     """
@@ -241,55 +626,44 @@ def pip_install_requirements():
     pip_log_dir = '/'.join(['/home',env.user,'.pip'])
     if exists(pip_log_dir): run('rm -f %s/*.txt'% pip_log_dir)
     
-    #determine what req files or bundle files we need to deploy
-    if not env.PIP_REQUIREMENTS:
-        req_files = {}.fromkeys(glob('req*'))
-    else:
-        req_files = {}.fromkeys(env.PIP_REQUIREMENTS)
-    
-    for key in req_files:
-        bundle = ''.join([key.split('.')[0],'.zip'])
-        if os.path.exists(os.path.join('dist',bundle)):
-            req_files[key] = bundle
-        
-    #determine the django version
-    file_patterns =''
-    django_version = get_version()
-    svn_version = django_version.find('SVN')
-    if svn_version > -1:
-        django_version = django_version[svn_version+4:]
-        django_req = ''.join(['-e svn+http://code.djangoproject.com/svn/django/trunk@',django_version,'#egg=Django'])
-    else:
-        other_builds = ['alpha','beta','rc']
-        for b in other_builds:
-            if b in django_version:
-                print "ERROR: Unsupported Django version", django_version
-                print "Define a DJANGO_REQUIREMENT pointing to the tar.gz for",django_version
-                print "and re-deploy, or use the official or SVN release of Django."
-                sys.exit(1)
-        django_req = ''.join(['Django==',django_version])
-
-    #if no requirements file exists create one
-    if not req_files:
-        f = open("requirements.txt","w+")
-        text = render_to_string('woven/requirements.txt', {'django':django_req})
-        f.write(text)
-        f.close()
+    req_hash = requirements_hash()
+    if version_state('requirements_hash') == req_hash:
         if env.verbosity:
-            print "Created local requirements.txt"
-        req_files["requirements.txt"]=''
-        
+            print env.host, 'Requirements unchanged. Skipping pip install'
+        #a copied environment still needs its requirements for the next incremental install
+        if not version_state('requirements'):
+            req_files = _requirements()[0]
+            set_version_state('requirements',object=_requirement_lines(sorted(req_files.keys())))
+        _record_requirements_env(req_hash)
+        return State(' '.join([env.host,'pip install requirements']))
+    req_files, django_req = _requirements()
     req_files_list = req_files.keys()
     req_files_list.sort()
+    file_patterns = ''
+    requirements = _requirement_lines(req_files_list)
+    
+    #diff against the requirements of the version this environment was cloned from
+    previous = None
+    base = version_state('cloned_from')
+    if base and env.PIP_INCREMENTAL and not [r for r in req_files_list if req_files[r]]:
+        with settings(project_fullname=base):
+            #False if the base predates recorded requirements
+            previous = version_state('requirements') or None
     
+    #install from a wheelhouse built for the host with the wheelhouse command
+    wheelhouse, wheels = '', None
+    if not [r for r in req_files_list if req_files[r]]:
+        local_wheelhouse, wheels = _wheelhouse_wheels(requirements)
+
     #patterns for bundles
     if req_files: file_patterns = '|'.join([file_patterns,'req*.zip'])
 
-    #create a pip cache & src directory
-    cache =  '/'.join([deployment_root(),'.pip','cache'])
-    src = '/'.join([deployment_root(),'.pip','src'])
+    #create a shared pip cache and seed the version src from the shared checkouts
+    cache =  '/'.join([pip_cache_root(),'cache'])
+    checkouts = '/'.join([pip_cache_root(),'src'])
+    src = '/'.join([deployment_root(),'env',env.project_fullname,'src'])
     deployed = mkdirs(cache)
-    deployed += mkdirs(src)
+    _seed_src(requirements, src, checkouts)
     #deploy bundles and any local copy of django
     local_dir = os.path.join(os.getcwd(),'dist')
     remote_dir = '/'.join([deployment_root(),'env',env.project_fullname,'dist'])
@@ -299,11 +673,36 @@ def pip_install_requirements():
     #deploy any requirement files
     deployed +=  deploy_files(os.getcwd(), remote_dir, pattern = 'req*') 
     
+    #sync the wheels to a wheelhouse shared by all projects
+    if wheels:
+        wheelhouse = '/'.join([deployment_root(),'.pip','wheelhouse'])
+        deployed += deploy_files(local_wheelhouse, wheelhouse, pattern='|'.join(wheels))
+    
     #install in the env
     out = State(' '.join([env.host,'pip install requirements']))
     python_path = '/'.join([deployment_root(),'env',env.project_fullname,'bin','python'])
+    pip = '/'.join([deployment_root(),'env',env.project_fullname,'bin','pip'])
     with settings(warn_only=True):
         with cd(remote_dir):
+            if previous is not None:
+                if env.verbosity:
+                    print ' * installing the changes from',base
+                options = '--src=%s --download-cache=%s --log=/home/%s/.pip/delta_pip_log.txt'% (src,cache,env.user)
+                if wheelhouse: options = ' '.join(['--no-index --find-links=%s'% wheelhouse, options])
+                failed = _pip_delta(previous, requirements, pip, options, bool(wheelhouse))
+                if failed:
+                    out.failed = True
+                    out.stderr += ' '.join([env.host, "ERROR INSTALLING REQUIREMENT CHANGES",'\n'])
+                req_files_list = []
+            elif wheelhouse:
+                if env.verbosity:
+                    print ' * installing',len(wheels),'wheels from',wheelhouse
+                install = run('%s install -q --no-index --find-links=%s --log=/home/%s/.pip/wheelhouse_pip_log.txt %s'%
+                              (pip, wheelhouse, env.user, _pip_args(requirements, True)))
+                if install.failed:
+                    out.failed = True
+                    out.stderr += ' '.join([env.host, "ERROR INSTALLING FROM",wheelhouse,'\n'])
+                req_files_list = []
             for req in req_files_list:
                 bundle = req_files[req]
                 if bundle: req=bundle
@@ -326,4 +725,11 @@ def pip_install_requirements():
         print out.stderr
         print "Review the pip install logs at %s/.pip and re-deploy"% deployment_root()
         sys.exit(1)
+    _share_src(requirements, src, checkouts)
+    evict_pip_cache()
+    #later versions with the same requirements can clone this environment
+    set_version_state('requirements_hash',object=req_hash)
+    #the next incremental install diffs against these
+    set_version_state('requirements',object=requirements)
+    _record_requirements_env(req_hash)
     return out
@@ -1,18 +1,270 @@
 #!/usr/bin/env python
-import os,socket, sys
+import base64, os, socket, sys, time
 import json
 
 from fabric.state import _AttributeDict, env
 from fabric.operations import run, sudo
 from fabric.context_managers import cd, settings
-from fabric.contrib.files import append, contains, exists
+from fabric.contrib.files import append, contains
 from fabric.decorators import runs_once
 
 from woven.decorators import run_once_per_version
-from woven.deployment import deploy_files, mkdirs, upload_template
-from woven.environment import deployment_root, version_state, _root_domain, get_packages
+from woven.deployment import batch, deploy_files, mkdirs, upload_template
+from woven.environment import deployment_root, version_state, set_version_state, server_state, set_server_state
+from woven.environment import _root_domain, get_packages, remote_python
+from woven.facts import command_fact, exists, invalidate, ls, read_file
 from woven.linux import add_user
 
+#Times a GET request to each url with its host header
+PROBE_SCRIPT = """
+import base64, json, sys, time, urllib2
+results = []
+for url, host, timeout in json.loads(base64.b64decode(sys.argv[1])):
+    request = urllib2.Request(url, headers={'Host':host})
+    start = time.time()
+    try:
+        status = urllib2.urlopen(request, timeout=timeout).getcode()
+    except urllib2.HTTPError, e:
+        status = e.code
+    except Exception:
+        status = 0
+    results.append((status, time.time()-start))
+print json.dumps(results)
+"""
+
+#backend ports of the blue and green slots
+BACKEND_PORTS = {'apache2':(10080,10082), 'gunicorn':(10081,10083)}
+
+def version_slot():
+    """
+    The blue/green slot of ``env.project_fullname``. The active version keeps its slot
+    and any other version gets the other one. '' if BLUE_GREEN is not enabled
+    """
+    if not env.BLUE_GREEN: return ''
+    #before the first blue/green activation the active version is on the blue ports
+    active = server_state('blue_green-%s'% env.project_name) or {}
+    slot = active.get('slot','blue')
+    if active.get('version') == env.project_fullname: return slot
+    return slot == 'blue' and 'green' or 'blue'
+
+def _backend_sites():
+    """
+    The sitesettings files that get their own gunicorn backend, the main settings.py first
+    """
+    return sorted(_sitesettings_files(), key=lambda f: f <> 'settings.py' and f) or ['settings.py']
+
+def backend_port(server, slot='', settings_file='settings.py'):
+    """
+    The port apache2 or gunicorn listens on for a slot. Each sitesettings
+    file has its own gunicorn backend 10 ports above the previous one
+    """
+    port = BACKEND_PORTS[server][slot == 'green' and 1 or 0]
+    if server == 'gunicorn' and settings_file in _backend_sites():
+        port += 10 * _backend_sites().index(settings_file)
+    return port
+
+def backend_job(server, slot=None, settings_file='settings.py'):
+    """
+    The upstart job of a gunicorn or uwsgi backend for a sitesettings file.
+    Defaults to the active slot
+    """
+    if slot is None:
+        slot = env.BLUE_GREEN and (server_state('blue_green-%s'% env.project_name) or {}).get('slot','') or ''
+    #prefixed settings eg admin_settings.py have their own job
+    site = settings_file <> 'settings.py' and settings_file[:-12] or ''
+    return '-'.join([part for part in [server, env.project_name, site, slot] if part])
+
+def backend_jobs(server, slot=None):
+    """
+    The upstart jobs of every site's backend
+    """
+    return [backend_job(server, slot, f) for f in _backend_sites()]
+
+def _backend_context(server, domain='', settings_file='settings.py'):
+    """
+    Template context for the backend of the current version's slot
+    """
+    slot = version_slot()
+    job = backend_job(server, slot, settings_file)
+    address = '127.0.0.1:%s'% backend_port(server, slot, settings_file)
+    binds = [address]
+    if server == 'gunicorn' and env.NGINX_UPSTREAM_SOCKET:
+        #blue/green health checks still need the port
+        binds = ['unix:/tmp/%s.sock'% job] + (slot and [address] or [])
+    return {"venv":'/'.join([deployment_root(),'env',slot and env.project_fullname or env.project_name]),
+            "backend_port":backend_port(server, slot, settings_file),
+            "backend":binds[0],
+            "binds":' '.join(['-b %s'% b for b in binds]),
+            "upstream_keepalive":env.NGINX_UPSTREAM_KEEPALIVE,
+            "process_name":'-'.join([part for part in [domain, slot] if part]),
+            "job":job}
+
+def host_resources():
+    """
+    The number of cpus and megabytes of memory on the host
+    """
+    try:
+        cpus = int(command_fact('cpu_count'))
+    except ValueError:
+        cpus = 1
+    try:
+        memory = int(command_fact('memory').split()[1]) // 1024
+    except (ValueError, IndexError):
+        memory = 0
+    return max(cpus, 1), memory
+
+def _prefixed_settings(prefix, *overrides):
+    """
+    The env settings starting with ``prefix`` (a string or tuple of strings)
+    updated by each of the ``overrides`` dictionaries in turn
+    """
+    conf = dict([(k, env[k]) for k in env.keys() if k.startswith(prefix)])
+    for override in overrides: conf.update(override)
+    return conf
+
+def _gunicorn_conf(settings_file):
+    """
+    The GUNICORN_ settings for a site's backend with any ROLE_GUNICORN and
+    then SITE_GUNICORN overrides
+    """
+    role = env.role_lookup.get(env.host_string,'')
+    return _prefixed_settings('GUNICORN_', env.ROLE_GUNICORN.get(role, {}),
+                              env.SITE_GUNICORN.get(settings_file.replace('.py',''), {}))
+
+def gunicorn_settings(settings_file='settings.py'):
+    """
+    The GUNICORN_ settings for a site's backend on the current host with any
+    ROLE_GUNICORN and then SITE_GUNICORN overrides.
+    
+    Workers (and threads for the gthread worker class) left at 0 are sized from
+    the host: 2 x cpus + 1 sync workers or 1 per cpu for other worker classes,
+    capped by the memory left after GUNICORN_RESERVED_MEMORY. The workers left
+    over by the sites with a fixed number of workers are shared between the others.
+    """
+    confs = [_gunicorn_conf(f) for f in _backend_sites()]
+    fixed = [c['GUNICORN_WORKERS'] for c in confs if c['GUNICORN_WORKERS']]
+    cpus, memory = host_resources()
+    return _size_gunicorn(_gunicorn_conf(settings_file), cpus, memory,
+                          len(confs), len(confs) - len(fixed), sum(fixed))
+
+def _size_gunicorn(conf, cpus, memory, sites=1, sized_sites=1, fixed_workers=0):
+    """
+    Size the workers and threads left at 0 in ``conf`` for one of ``sites`` backends
+    on a host with ``cpus`` and ``memory`` megabytes. ``sized_sites`` share what is
+    left after the ``fixed_workers`` of the other sites
+    """
+    conf = dict(conf)
+    worker_class = conf['GUNICORN_WORKER_CLASS'] or 'sync'
+    if not conf['GUNICORN_WORKERS']:
+        workers = worker_class == 'sync' and 2 * cpus + 1 or cpus
+        if memory:
+            workers = min(workers, (memory - conf['GUNICORN_RESERVED_MEMORY']) // conf['GUNICORN_WORKER_MEMORY'])
+        conf['GUNICORN_WORKERS'] = max(1, (workers - fixed_workers) // max(1, sized_sites))
+    if worker_class == 'gthread' and not conf['GUNICORN_THREADS']:
+        conf['GUNICORN_THREADS'] = max(2, 4 * cpus // max(1, sites) // conf['GUNICORN_WORKERS'])
+    return conf
+
+def gunicorn_options(conf):
+    """
+    gunicorn command line options for the non default ``conf`` values
+    """
+    options = ['--workers=%s'% conf['GUNICORN_WORKERS']]
+    for setting, option in [('GUNICORN_WORKER_CLASS','--worker-class'),
+                            ('GUNICORN_THREADS','--threads'),
+                            ('GUNICORN_WORKER_CONNECTIONS','--worker-connections'),
+                            ('GUNICORN_KEEPALIVE','--keep-alive'),
+                            ('GUNICORN_BACKLOG','--backlog'),
+                            ('GUNICORN_TIMEOUT','--timeout'),
+                            ('GUNICORN_MAX_REQUESTS','--max-requests'),
+                            ('GUNICORN_MAX_REQUESTS_JITTER','--max-requests-jitter')]:
+        if conf.get(setting): options.append('%s=%s'% (option, conf[setting]))
+    return ' '.join(options)
+
+def _apache_sites():
+    """
+    The number of apache sites on the host once this project's domains are enabled
+    """
+    path = '/etc/apache2/sites-enabled'
+    others = exists(path) and [s for s in ls(path) if s not in _ls_sites(path)] or []
+    return len(others) + len(domain_sites())
+
+def apache_settings():
+    """
+    The APACHE_ and WSGI_ settings for the current host with any ROLE_APACHE overrides.
+    
+    WSGI_PROCESSES left at 0 gives each apache site a daemon process per cpu, capped by
+    its share of the memory left after APACHE_RESERVED_MEMORY. The MPM is sized to
+    serve the daemon threads of every site
+    """
+    role = env.role_lookup.get(env.host_string,'')
+    conf = _prefixed_settings(('APACHE_','WSGI_'), env.ROLE_APACHE.get(role, {}))
+    cpus, memory = host_resources()
+    return _size_apache(conf, cpus, memory, _apache_sites())
+
+def _size_apache(conf, cpus, memory, sites):
+    """
+    Size the APACHE_ and WSGI_ settings left at 0 in ``conf`` for a host
+    with ``cpus``, ``memory`` megabytes and ``sites`` apache sites
+    """
+    conf = dict(conf)
+    sites = max(1, sites)
+    if not conf['WSGI_PROCESSES']:
+        processes = cpus
+        if memory:
+            processes = min(processes, (memory - conf['APACHE_RESERVED_MEMORY']) // conf['WSGI_PROCESS_MEMORY'] // sites)
+        conf['WSGI_PROCESSES'] = max(1, processes)
+    if not conf['APACHE_MAX_CLIENTS']:
+        #a whole number of 25 thread worker children, and no fewer than the previous default of 100
+        threads = sites * conf['WSGI_PROCESSES'] * conf['WSGI_THREADS']
+        conf['APACHE_MAX_CLIENTS'] = max(4, (threads + 24) // 25) * 25
+    if not conf['APACHE_START_SERVERS']:
+        conf['APACHE_START_SERVERS'] = max(1, min(cpus, conf['APACHE_MAX_CLIENTS'] // 25))
+    conf['sites'], conf['cpus'] = sites, cpus
+    return conf
+
+def static_profile(domain):
+    """
+    The nginx static serving directives for a domain or None if the profile is off.
+    
+    NGINX_STATIC_ settings can be overridden per domain in SITE_STATIC_PROFILES
+    """
+    conf = _prefixed_settings('NGINX_STATIC', env.SITE_STATIC_PROFILES.get(domain, {}))
+    if not conf['NGINX_STATIC_PROFILE']: return None
+    return {'expires':conf['NGINX_STATIC_EXPIRES'],
+            'media_expires':conf['NGINX_STATIC_MEDIA_EXPIRES'],
+            'open_file_cache':conf['NGINX_STATIC_OPEN_FILE_CACHE'],
+            'gzip_static':conf['NGINX_STATIC_GZIP'],
+            'sendfile_max_chunk':conf['NGINX_STATIC_SENDFILE_MAX_CHUNK']}
+
+PROXY_CACHE_ROOT = '/var/cache/nginx/woven'
+
+def proxy_cache(domain):
+    """
+    The nginx proxy cache settings for a domain or None if it isn't cached.
+    
+    NGINX_PROXY_CACHE_ settings can be overridden per domain in SITE_PROXY_CACHES
+    """
+    conf = _prefixed_settings('NGINX_PROXY_CACHE', env.SITE_PROXY_CACHES.get(domain, {}))
+    if not conf['NGINX_PROXY_CACHE']: return None
+    return {'path':'/'.join([PROXY_CACHE_ROOT,domain.replace('.','_')]),
+            'ttl':conf['NGINX_PROXY_CACHE_TTL'],
+            'zone_size':conf['NGINX_PROXY_CACHE_ZONE_SIZE'],
+            'max_size':conf['NGINX_PROXY_CACHE_MAX_SIZE'],
+            #requests with any of these cookies go to the backend
+            'bypass':' '.join(['$cookie_%s'% c for c in conf['NGINX_PROXY_CACHE_BYPASS_COOKIES']]) or '0'}
+
+def purge_proxy_cache():
+    """
+    Empty the nginx proxy caches of the project's domains
+    """
+    caches = [c for c in [proxy_cache(d.name) for d in domain_sites()] if c]
+    if not caches: return
+    if env.verbosity:
+        print env.host, "PURGING the nginx proxy cache"
+    with batch(use_sudo=True) as commands:
+        for cache in caches:
+            commands.add("find %s -mindepth 1 -delete"% cache['path'], warn_only=True)
+
 def _activate_sites(path, filenames):
     enabled_sites = _ls_sites(path)            
     for site in enabled_sites:
@@ -37,6 +289,7 @@ def _deploy_webconf(remote_dir,template):
     users_added = []
     
     domains = domain_sites()
+    if 'apache' in template: apache_conf = apache_settings()
     for d in domains:
         u_domain = d.name.replace('.','_')
         wsgi_filename = d.settings.replace('.py','.wsgi')
@@ -55,6 +308,16 @@ def _deploy_webconf(remote_dir,template):
                     "MEDIA_URL":media_url,
                     "STATIC_URL":static_url,
                     }
+        context.update(_backend_context('gunicorn' in template and 'gunicorn' or 'apache2', d.name, d.settings))
+        if 'apache' in template:
+            context.update({"wsgi_processes":apache_conf['WSGI_PROCESSES'],
+                            "wsgi_threads":apache_conf['WSGI_THREADS'],
+                            "wsgi_maximum_requests":apache_conf['WSGI_MAXIMUM_REQUESTS']})
+        context["static_profile"] = static_profile(d.name)
+        context["proxy_cache"] = proxy_cache(d.name)
+        if context["proxy_cache"] and not exists(PROXY_CACHE_ROOT):
+            sudo('mkdir -p %s && chown www-data:www-data %s'% (PROXY_CACHE_ROOT, PROXY_CACHE_ROOT))
+            invalidate(PROXY_CACHE_ROOT)
 
         upload_template('/'.join(['woven',template]),
                         filename,
@@ -77,7 +340,7 @@ def _site_users():
     """
     Get a list of site_n users
     """
-    userlist = sudo("cat /etc/passwd | awk '/site/'").split('\n')
+    userlist = read_file('/etc/passwd').split('\n')
     siteuserlist = [user.split(':')[0] for user in userlist if 'site_' in user]
     return siteuserlist
 
@@ -85,19 +348,61 @@ def _ls_sites(path):
     """
     List only sites in the domain_sites() to ensure we co-exist with other projects
     """
-    with cd(path):
-        sites = run('ls').split('\n')
-        doms =  [d.name for d in domain_sites()]
-        dom_sites = []
-        for s in sites:
-            ds = s.split('-')[0]
-            ds = ds.replace('_','.')
-            if ds in doms and s not in dom_sites:
-                dom_sites.append(s)
+    sites = ls(path)
+    doms =  [d.name for d in domain_sites()]
+    dom_sites = []
+    for s in sites:
+        ds = s.split('-')[0]
+        ds = ds.replace('_','.')
+        if ds in doms and s not in dom_sites:
+            dom_sites.append(s)
     return dom_sites
 
 
 
+def _http_probe(requests, timeout=10):
+    """
+    Make http GET requests from the node itself in a single round trip.
+    
+    ``requests`` is a list of (url, host header) tuples
+    
+    Returns a list of (status, seconds) tuples. The status is 0 if
+    the connection failed
+    """
+    if not requests: return []
+    requests = [(url, host, timeout) for url, host in requests]
+    output = remote_python(PROBE_SCRIPT, base64.b64encode(json.dumps(requests)))
+    if output.failed: return [(0, 0.0) for r in requests]
+    return json.loads(output.split('\n')[-1])
+
+def health_check(base_url='http://127.0.0.1', timeout=None, domains=None):
+    """
+    Request HEALTH_CHECK_URL on every domain of the project, or just ``domains``,
+    at ``base_url`` until all of them respond with a status below 500.
+    
+    Returns False if any domain is still failing after ``timeout`` seconds
+    (defaults to HEALTH_CHECK_TIMEOUT)
+    """
+    if timeout is None: timeout = env.HEALTH_CHECK_TIMEOUT
+    url = ''.join([base_url, env.HEALTH_CHECK_URL])
+    if domains is None: domains = [d.name for d in domain_sites()]
+    if env.verbosity:
+        print env.host, "HEALTH CHECK", url
+    deadline = time.time() + timeout
+    while True:
+        results = _http_probe([(url, d) for d in domains])
+        failing = [d for d, (status, seconds) in zip(domains, results) if not 0 < status < 500]
+        if not failing:
+            if env.verbosity:
+                print ' * passed'
+            return True
+        if time.time() > deadline: break
+        time.sleep(2)
+    if env.verbosity:
+        for d, (status, seconds) in zip(domains, results):
+            print ' *', d, status or 'connection failed'
+    return False
+
 def _sitesettings_files():
     """
     Get a list of sitesettings files
@@ -180,6 +485,32 @@ def domain_sites():
             
     return env.domains
 
+def deploy_apache_conf():
+    """
+    Render the apache MPM settings for the host into /etc/apache2/conf.d
+    """
+    conf = apache_settings()
+    if env.verbosity:
+        print env.host,"DEPLOYING apache settings for", conf['sites'], "sites"
+    changed = upload_template('woven/apache-mpm-template.txt',
+                    '/etc/apache2/conf.d/woven-mpm.conf',
+                    {"sites":conf['sites'],
+                     "cpus":conf['cpus'],
+                     "keepalive":conf['APACHE_KEEPALIVE'],
+                     "start_servers":conf['APACHE_START_SERVERS'],
+                     "max_spare_servers":conf['APACHE_START_SERVERS'] * 2,
+                     "max_clients":conf['APACHE_MAX_CLIENTS'],
+                     "server_limit":max(16, conf['APACHE_MAX_CLIENTS'] // 25)},
+                    use_sudo=True, backup=False, modified_only=True)
+    if changed:
+        sudo('chmod ugo+r /etc/apache2/conf.d/woven-mpm.conf')
+        #the graceful reload applies the new settings except a higher ServerLimit
+        previous = server_state('apache-max-clients')
+        if previous and previous < conf['APACHE_MAX_CLIENTS']:
+            print env.host,"WARNING: apache MaxClients has grown from %s to %s."% (previous, conf['APACHE_MAX_CLIENTS'])
+            print "A graceful reload keeps the old ServerLimit. Run 'sudo apache2ctl restart' at a quiet time to apply it"
+        set_server_state('apache-max-clients',object=conf['APACHE_MAX_CLIENTS'])
+
 @run_once_per_version
 def deploy_webconf():
     """ Deploy nginx and other wsgi server site configurations to the host """
@@ -191,8 +522,20 @@ def deploy_webconf():
             print env.host,"DEPLOYING webconf:"
         if not exists(log_dir):
             run('ln -s /var/log log')
+            invalidate(log_dir)
+        #proxy settings for the project's nginx sites
+        upload_template('woven/nginx-proxy-template.txt',
+                        '/etc/nginx/proxy-%s.conf'% env.project_name,
+                        {"project_name":env.project_name,
+                         "upstream_keepalive":env.NGINX_UPSTREAM_KEEPALIVE,
+                         "proxy_buffering":env.NGINX_PROXY_BUFFERING,
+                         "proxy_buffer_size":env.NGINX_PROXY_BUFFER_SIZE,
+                         "proxy_buffers":env.NGINX_PROXY_BUFFERS,
+                         "proxy_busy_buffers_size":env.NGINX_PROXY_BUSY_BUFFERS_SIZE},
+                        use_sudo=True, backup=False)
         #deploys confs for each domain based on sites app
         if 'apache2' in get_packages():
+            deploy_apache_conf()
             deployed += _deploy_webconf('/etc/apache2/sites-available','django-apache-template.txt')
             deployed += _deploy_webconf('/etc/nginx/sites-available','nginx-template.txt')
         elif 'gunicorn' in get_packages():
@@ -200,8 +543,10 @@ def deploy_webconf():
         
         if not exists('/var/www/nginx-default'):
             sudo('mkdir /var/www/nginx-default')
+            invalidate('/var/www/nginx-default')
         upload_template('woven/maintenance.html','/var/www/nginx-default/maintenance.html',use_sudo=True)
         sudo('chmod ugo+r /var/www/nginx-default/maintenance.html')
+        if env.BLUE_GREEN: set_version_state('webconf_slot',object=version_slot())
     else:
         print env.host,"""WARNING: Apache or Nginx not installed"""
         
@@ -229,11 +574,15 @@ def deploy_wsgi():
         if not exists(postactivate):
             append('#!/bin/bash', postactivate)
             run('chmod +x %s'% postactivate)
+            invalidate(postactivate)
         if not contains('PYTHONPATH',postactivate):
             append(pap,postactivate)
         
     if env.verbosity:
         print env.host,"DEPLOYING wsgi", wsgi, remote_dir
+    if wsgi == 'gunicorn' and not exists('/var/log/gunicorn'):
+        sudo('mkdir -p /var/log/gunicorn')
+        invalidate('/var/log/gunicorn')
 
     for file in _sitesettings_files(): 
         deployed += mkdirs(remote_dir)
@@ -246,6 +595,11 @@ def deploy_wsgi():
                        "project_apps_path":env.PROJECT_APPS_PATH,
                        "settings": settings_module,
                        }
+            context.update(_backend_context(wsgi, '', file))
+            if wsgi == 'gunicorn':
+                conf = gunicorn_settings(file)
+                context.update({"log_level":conf['GUNICORN_LOG_LEVEL'],
+                                "gunicorn_options":gunicorn_options(conf)})
             if wsgi == 'apache2':
                 filename = file.replace('.py','.wsgi')
                 upload_template('/'.join(['woven','django-wsgi-template.txt']),
@@ -253,13 +607,18 @@ def deploy_wsgi():
                                 context,
                             )
             elif wsgi == 'gunicorn':
-                filename = 'gunicorn-%s.conf'% env.project_name
-                upload_template('/'.join(['woven','gunicorn.conf']),
+                filename = '%s.conf'% context['job']
+                changed = upload_template('/'.join(['woven','gunicorn.conf']),
                                 filename,
                                 context,
                                 backup=False,
-                                use_sudo=True
-                            )                
+                                use_sudo=True,
+                                modified_only=exists('/'.join([remote_dir,filename]))
+                            )
+                #upstart only reads the job conf when the job starts
+                restart = server_state('gunicorn-restart') or []
+                if changed and context['job'] not in restart:
+                    set_server_state('gunicorn-restart',object=restart+[context['job']])
                 
             if env.verbosity:
                 print " * uploaded", filename
@@ -271,17 +630,21 @@ def deploy_wsgi():
             elif wsgi == 'gunicorn':
                 sudo("chown root:root %s"% filename)
                 sudo("chmod go+r %s"% filename)
+    if env.BLUE_GREEN: set_version_state('wsgi_slot',object=version_slot())
+    if wsgi == 'gunicorn':
+        #so the jobs of removed sites can be stopped later
+        set_version_state('gunicorn_jobs',object=backend_jobs('gunicorn', version_slot()))
                 
     return deployed
 
 def webserver_list():
     """
-    list of webserver packages
+    list of webserver packages, with nginx last so backends are ready before it
     """
     p = set(get_packages())
     w = set(['apache2','gunicorn','uwsgi','nginx'])
     installed = p & w
-    return list(installed)
+    return sorted(installed, key=lambda s: s == 'nginx')
     
 def reload_webservers():
     """
@@ -321,11 +684,12 @@ def stop_webserver(server):
                 print '',a
     elif server == 'gunicorn':
         with settings(warn_only=True):
-            if env.verbosity:
-                print env.host,"STOPPING","%s-%s"% (server,env.project_name)
-            a = sudo("stop %s-%s"% (server,env.project_name))
-            if env.verbosity and a.strip():
-                print '',a
+            for job in backend_jobs(server):
+                if env.verbosity:
+                    print env.host,"STOPPING",job
+                a = sudo("stop %s"% job)
+                if env.verbosity and a.strip():
+                    print '',a
     return True
 
 def start_webserver(server):
@@ -358,13 +722,215 @@ def start_webserver(server):
         if env.verbosity:
             print ' *',n
     else:
-        if env.verbosity:
-            print env.host, "STARTING","%s-%s"% (server,env.project_name)
         with settings(warn_only=True):
-            n = sudo('start %s-%s'% (server,env.project_name))
-            if env.verbosity and n.strip():
-                print ' *', n
+            for job in backend_jobs(server):
+                if env.verbosity:
+                    print env.host, "STARTING",job
+                n = sudo('start %s'% job)
+                if env.verbosity and n.strip():
+                    print ' *', n
             
     return True
 
-    
\ No newline at end of file
+def reload_webserver(server):
+    """
+    Gracefully reload server, or start it if it isn't running.
+    
+    Existing workers finish their in-flight requests while new workers
+    load the active version. Gunicorn jobs whose conf has changed are
+    restarted since the master keeps its command line on a reload
+    """
+    if server == 'nginx':
+        #nginx is always reloaded
+        return start_webserver(server)
+    jobs = server == 'apache2' and [server] or backend_jobs(server)
+    if env.verbosity:
+        print env.host,"GRACEFULLY RELOADING", ' '.join(jobs)
+    with settings(warn_only=True):
+        if server == 'apache2':
+            failed = sudo("apache2ctl graceful", pty=False).failed
+        else:
+            restart = server_state('gunicorn-restart') or []
+            failed = []
+            for job in jobs:
+                if job in restart:
+                    if env.verbosity:
+                        print ' * restarting', job, 'for its new conf'
+                    result = sudo("restart %s || start %s"% (job, job))
+                else:
+                    #upstart sends the job a HUP
+                    result = sudo("reload %s"% job)
+                if result.failed: failed.append(job)
+            if restart: set_server_state('gunicorn-restart',delete=True)
+    if failed:
+        return start_webserver(server)
+    return True
+
+def _percentiles(seconds):
+    """
+    The 50th, 95th and 99th percentile of a list of request times
+    """
+    seconds = sorted(seconds)
+    if not seconds: return {}
+    return dict([('p%s'% p, seconds[int(round(p / 100.0 * (len(seconds) - 1)))]) for p in (50, 95, 99)])
+
+def _warmup_requests(server, slot):
+    """
+    (url, host) for the WARMUP_URLS of every domain on its backend for ``slot``.
+    
+    WARMUP_URLS is a list of paths for all domains or a domain:[paths] dictionary
+    """
+    requests = []
+    for d in domain_sites():
+        if isinstance(env.WARMUP_URLS, dict): paths = env.WARMUP_URLS.get(d.name, [])
+        else: paths = env.WARMUP_URLS
+        base_url = 'http://127.0.0.1:%s'% backend_port(server, slot, d.settings)
+        requests += [(''.join([base_url, path]), d.name) for path in paths]
+    return requests
+
+def warm_up(server, slot):
+    """
+    Request the WARMUP_URLS on the new version's backend before it gets any traffic,
+    then time WARMUP_REQUESTS rounds of them on the new and the active backends.
+    
+    Returns False if a request fails or the new version's 95th percentile is more
+    than WARMUP_MAX_REGRESSION slower than the active version's
+    """
+    requests = _warmup_requests(server, slot)
+    if not requests: return True
+    if env.verbosity:
+        print env.host, "WARMING UP", len(requests), "urls"
+    _http_probe(requests)
+    rounds = max(1, env.WARMUP_REQUESTS)
+    results = _http_probe(requests * rounds)
+    failing = set([url for (url, host), (status, seconds) in zip(requests * rounds, results) if not 0 < status < 500])
+    latency = _percentiles([seconds for status, seconds in results])
+    set_version_state('warmup_latency',object=latency)
+    if env.verbosity:
+        print ' * latency', ' '.join(['%s %.3fs'% (p, latency[p]) for p in sorted(latency)])
+    if failing:
+        for url in sorted(failing):
+            print env.host, "ERROR: warm up request failed", url
+        return False
+    if not env.WARMUP_MAX_REGRESSION: return True
+    
+    #compare with the active version on the other slot
+    active_slot = slot == 'blue' and 'green' or 'blue'
+    active_requests = _warmup_requests(server, active_slot)
+    active_results = [seconds for status, seconds in _http_probe(active_requests * rounds) if 0 < status < 500]
+    if not active_results: return True
+    active_latency = _percentiles(active_results)
+    if env.verbosity:
+        print ' * active version latency', ' '.join(['%s %.3fs'% (p, active_latency[p]) for p in sorted(active_latency)])
+    #ignore differences of a few milliseconds on fast pages
+    limit = max(active_latency['p95'] * (1 + env.WARMUP_MAX_REGRESSION), active_latency['p95'] + 0.01)
+    if latency['p95'] > limit:
+        print env.host, "ERROR: the 95th percentile latency regressed from %.3fs to %.3fs"% (active_latency['p95'], latency['p95'])
+        return False
+    return True
+
+def _switch_apache_sites(enable=[], disable=[]):
+    """
+    Enable and disable apache site confs and gracefully reload apache
+    """
+    with batch(use_sudo=True) as commands:
+        for site in disable:
+            commands.add("rm -f /etc/apache2/sites-enabled/%s"% site)
+        for site in enable:
+            commands.add("chmod 644 /etc/apache2/sites-available/%s"% site)
+            commands.add("ln -sfn /etc/apache2/sites-available/%s /etc/apache2/sites-enabled/%s"% (site,site))
+    invalidate('/etc/apache2/sites-enabled')
+    reload_webserver('apache2')
+
+def start_slot(sites):
+    """
+    Start the backend of ``env.project_fullname`` on its blue/green slot alongside
+    the active version, and wait for it to pass the health check and warm up on its own port.
+    
+    ``sites`` are the version's site conf filenames. Exits if the health check fails
+    """
+    slot = version_slot()
+    server = 'apache2' in get_packages() and 'apache2' or 'gunicorn'
+    #the active version may have changed slot since this version was deployed
+    job_confs = ['/etc/init/%s.conf'% job for job in backend_jobs('gunicorn', slot)]
+    if version_state('webconf_slot') <> slot or version_state('wsgi_slot') <> slot or \
+            (server == 'gunicorn' and not all([exists(conf) for conf in job_confs])):
+        with settings(patch=True):
+            deploy_webconf()
+            deploy_wsgi()
+    if env.verbosity:
+        print env.host, "STARTING", env.project_fullname, "on the", slot, "slot"
+    if server == 'apache2':
+        _switch_apache_sites(enable=sites)
+    else:
+        with settings(warn_only=True):
+            for job in backend_jobs(server, slot):
+                sudo('restart %s || start %s'% (job, job))
+    #each site's gunicorn backend has its own port
+    for file in server == 'gunicorn' and _backend_sites() or ['settings.py']:
+        domains = server == 'gunicorn' and [d.name for d in domain_sites() if d.settings == file] or None
+        if not health_check('http://127.0.0.1:%s'% backend_port(server, slot, file), domains=domains):
+            print env.host, "ERROR:", env.project_fullname, "failed the health check. The active version is still serving"
+            stop_slot(slot, sites)
+            sys.exit(1)
+    if not warm_up(server, slot):
+        print env.host, "ERROR:", env.project_fullname, "failed the warm up. The active version is still serving"
+        stop_slot(slot, sites)
+        sys.exit(1)
+    return slot
+
+def version_jobs(version):
+    """
+    The gunicorn jobs deployed for a version
+    """
+    with settings(project_fullname=version):
+        return version_state('gunicorn_jobs') or []
+
+def _remove_jobs(jobs):
+    """
+    Stop gunicorn jobs and remove their upstart confs
+    """
+    with settings(warn_only=True):
+        for job in jobs:
+            if env.verbosity:
+                print env.host, "STOPPING", job
+            sudo('stop %s'% job)
+            #don't start it again on boot
+            sudo('rm -f /etc/init/%s.conf'% job)
+    invalidate('/etc/init')
+
+def remove_stale_jobs(version):
+    """
+    Stop the gunicorn jobs of the previously active ``version`` whose
+    sitesettings module has since been removed
+    """
+    if not 'gunicorn' in get_packages(): return
+    current = backend_jobs('gunicorn')
+    _remove_jobs([job for job in version_jobs(version) if job not in current])
+
+def stop_slot(slot, sites=[], version=''):
+    """
+    Stop the backend on a blue/green slot. With apache the ``sites`` are disabled.
+    
+    ``version`` is the version on the slot, whose jobs are stopped too
+    """
+    if 'apache2' in get_packages():
+        _switch_apache_sites(disable=sites)
+        return
+    jobs = backend_jobs('gunicorn', slot)
+    #the jobs used before blue/green activation
+    if slot == 'blue': jobs += backend_jobs('gunicorn', '')
+    #including the sites that have since been removed
+    if version: jobs += [job for job in version_jobs(version) if job not in jobs]
+    _remove_jobs(jobs)
+
+def drain_slot(slot, sites=[], version=''):
+    """
+    Wait BLUE_GREEN_GRACE seconds for the previous ``version`` to finish its
+    requests then stop it
+    """
+    if env.verbosity:
+        print env.host, "DRAINING the", slot, "slot for", env.BLUE_GREEN_GRACE, "seconds"
+    time.sleep(env.BLUE_GREEN_GRACE)
+    stop_slot(slot, sites, version)
+